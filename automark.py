@@ -19,28 +19,50 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 ----------------------------------------------------------------------
 
 This script runs the client script for AutoMark
-There are 2 main functions the end-user should use:
+There are 4 main functions the end-user should use:
 * get_progress(username) --- just to get the current progress to the stdout
 * test_student_function(username, function, arg_keys) --- to test the provided function 
     and to print the result / error to the stdout
-
-This scripts automatically downloads local tests into the `local_tests` folder
+* test_student_functions(username, functions) --- to test several functions
+    with a single request to get the inputs and a single request to check the answers
+* run_local_tests(username, function, arg_keys) --- to run only the local tests
+    and to get a detailed report
+
+The script needs `automark_data.py` and `automark_compare.py` to be placed
+in the same folder. The answers are compared with the outputs of the tests
+by `automark_compare.py`, the same way as on the server.
+
+This scripts automatically downloads local tests into the `local_tests` folder.
+Each assignment has its own file, which is downloaded only when it is tested
+and is re-downloaded only when its md5 changes on the server.
 Compatible with Python 2/3
 """
 
 from __future__ import print_function
 import os
 import sys
+import glob
+import gzip
 import json
+import zlib
 import requests
-import shutil
+import requests.adapters
 import numpy as np
 import hashlib
+import struct
+import select
+import time
+import multiprocessing
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 try:
-    import cPickle as pickle
+    import tracemalloc
 except ImportError:
-    import pickle
+    tracemalloc = None
+
+import automark_compare
+import automark_data
 
 try:
     FileNotFoundError
@@ -52,11 +74,33 @@ class ServerError(BaseException):
     pass
 
 
+# `time.perf_counter` and `time.process_time` are not available in Python 2
+_timer = getattr(time, 'perf_counter', time.time)
+_cpu_timer = getattr(time, 'process_time', None) or time.clock
+
+
 class Config:
     host = 'http://127.0.0.1:1234/'
     cwd = os.path.dirname(os.path.realpath(__file__))
     test_folder = os.path.join(cwd, 'local_tests')
-    test_path = os.path.join(test_folder, 'tests.pickle')
+    # (connect, read) timeouts in seconds
+    timeout = (10, 60)
+    # transient failures of idempotent requests are retried with exponential backoff
+    retries = 3
+    backoff_factor = 0.5
+    # the local tests are checked against the server at most once in this number of seconds
+    validation_ttl = 10 * 60
+    # the local tests are run by this number of threads, or processes if `case_timeout` is set
+    workers = 1
+    # a test case fails if it runs longer than this number of seconds. `None` means no limit
+    # the test cases are run in forked processes, so a hung test case is killed
+    case_timeout = None
+    # the time, the CPU time and the peak memory of each test case are measured
+    profile = False
+    # a function is flagged if it is slower than the reference by more than this factor
+    slowdown_limit = 10.0
+    # the local tests are downloaded compressed. `None` to download them as they are
+    compression = 'gzip'
 
 
 # MAIN FUNCTIONS
@@ -65,12 +109,7 @@ def get_progress(username):
     # Args:
         username - a case-sensitive string
     """
-    endpoint = Config.host + 'get_progress/{}'.format(username)
-    response = requests.get(endpoint)
-    data = response.json()
-
-    if 'error' in data:
-        raise ServerError(data['error'])
+    data = _get_progress(username)
 
     print('-' * 45)
     print('| {:42}|'.format(data['name']))
@@ -81,22 +120,24 @@ def get_progress(username):
     print('-' * 45)
 
 
-def test_student_function(username, function, arg_keys):
+def test_student_function(username, function, arg_keys, refresh=False):
     """Test the provided function and print the result / error to the stdout
     # Args:
         username - a case-sensitive string
         function - a function as an object. callable
         arg_keys - a list of the function's arguments as srings. 
             Example: `['arg1', 'arg2']`
+        refresh - if `True`, the local tests are checked against the server
+            even if they were recently checked
     """
-    if not _local_tests_are_valid():
-        _remove_local_tests()
-        print('Downloading local tests...')
-        _load_local_tests(username)
+    _update_local_tests(username, [function.__name__], refresh)
 
     print('Running local tests...')
-    if _passed_local_tests(function, arg_keys):
+    report = _run_local_tests(function, arg_keys)
+    if report.success:
         print('{} successfully passed local tests'.format(function.__name__))
+        if Config.profile:
+            print(report)
         print('Running remote test...')
         sys.stdout.flush()
 
@@ -106,100 +147,702 @@ def test_student_function(username, function, arg_keys):
             print("Test failed. Please review your code.")
     else:
         print('{} failed some local tests'.format(function.__name__))
+        print(report)
+
+
+def test_student_functions(username, functions):
+    """Test the provided functions and print the results / errors to the stdout
+    # Args:
+        username - a case-sensitive string
+        functions - a list of pairs `(function, arg_keys)`.
+            Example: `[(matmul, ['A', 'B']), (sigmoid, ['x'])]`
+    """
+    names = [function.__name__ for function, _ in functions]
+    data = _get_test_inputs(username, names)
+    _update_local_tests(username, names, manifest=data['local_tests'])
+
+    print('Running local tests...')
+    answers = []
+    for function, arg_keys in functions:
+        report = _run_local_tests(function, arg_keys)
+        if report.success:
+            print('{} successfully passed local tests'.format(function.__name__))
+            test_case = data['inputs'][function.__name__]
+            test_result = function(*_parse_input(test_case['input'], arg_keys))
+            answers.append((function.__name__, test_case['ipd'], test_result))
+        else:
+            print('{} failed some local tests'.format(function.__name__))
+            print(report)
+
+    if not answers:
+        return
+
+    print('Running remote tests...')
+    sys.stdout.flush()
+    success = _check_answers(username, answers)
+    for name, _, _ in answers:
+        if success[name]:
+            print("{}: test was successful. Congratulations!".format(name))
+        else:
+            print("{}: test failed. Please review your code.".format(name))
+
+
+def run_local_tests(username, function, arg_keys, workers=None, case_timeout=None, profile=None):
+    """Run the local tests of the provided function and return a `LocalTestReport`
+    # Args:
+        username - a case-sensitive string
+        function - a function as an object. callable
+        arg_keys - a list of the function's arguments as srings. 
+            Example: `['arg1', 'arg2']`
+        workers - the number of threads running the test cases. `Config.workers` by default
+        case_timeout - the time limit of a test case in seconds. `Config.case_timeout` by default.
+            The test cases are run in `workers` processes, the process of a test case
+            which exceeds the limit is killed. Without `os.fork` they are run in threads,
+            which can not be stopped, and the test cases which are left without a thread
+            are reported as not run
+        profile - if `True`, the test cases are run one by one and the CPU time and
+            the peak memory are measured. Each test case is run twice,
+            as the memory is measured separately. `Config.profile` by default
+    """
+    _update_local_tests(username, [function.__name__])
+    return _run_local_tests(function, arg_keys, workers, case_timeout, profile)
+
+
+class LocalTestReport(object):
+    """The result of the local tests
+    # Attributes:
+        n_cases - the number of test cases
+        n_passed - the number of passed test cases
+        n_not_run - the number of test cases which were not run, as all threads were
+            busy with the timed out test cases. They are neither passed nor failed
+        first_failure - the index of the first failed test case or `None`
+        failure_reason - why the first failed test case failed
+        max_abs_error - the maximum absolute error over all test cases
+        max_rel_error - the maximum relative error over all test cases
+        times - the wall time of each test case in seconds
+        cpu_times - the CPU time of each test case in seconds, if profiled
+        peak_memory - the peak memory allocated by each test case in bytes, if profiled
+        reference_times - the wall time of the reference solution for each test case,
+            if it is provided with the local tests
+    """
+
+    def __init__(self, n_cases):
+        self.n_cases = n_cases
+        self.n_passed = 0
+        self.n_not_run = 0
+        self.first_failure = None
+        self.failure_reason = None
+        self.max_abs_error = 0.0
+        self.max_rel_error = 0.0
+        self.times = [None] * n_cases
+        self.cpu_times = [None] * n_cases
+        self.peak_memory = [None] * n_cases
+        self.reference_times = None
+
+    @property
+    def success(self):
+        return self.n_passed == self.n_cases
+
+    @property
+    def slowdown(self):
+        # how many times the function is slower than the reference solution
+        if self.reference_times is None or None in self.times:
+            return None
+        return sum(self.times) / max(sum(self.reference_times), 1e-9)
+
+    @property
+    def is_too_slow(self):
+        return self.slowdown is not None and self.slowdown > Config.slowdown_limit
+
+    def __str__(self):
+        lines = ['passed {} / {} test cases'.format(self.n_passed, self.n_cases)]
+        if self.n_not_run:
+            lines[0] += ', {} test cases were not run'.format(self.n_not_run)
+        if self.first_failure is not None:
+            lines.append('the first failed test case: #{} ({})'.format(self.first_failure,
+                                                                      self.failure_reason))
+        lines.append('max abs error: {:.3g}, max rel error: {:.3g}'.format(self.max_abs_error,
+                                                                         self.max_rel_error))
+        times = [t for t in self.times if t is not None]
+        if times:
+            lines.append('total time: {:.3f} sec, the slowest test case: {:.3f} sec'.format(
+                sum(times), max(times)))
+        cpu_times = [t for t in self.cpu_times if t is not None]
+        if cpu_times:
+            lines.append('total CPU time: {:.3f} sec'.format(sum(cpu_times)))
+        peak_memory = [m for m in self.peak_memory if m is not None]
+        if peak_memory:
+            lines.append('peak memory: {:.1f} KiB'.format(max(peak_memory) / 1024.0))
+        if self.slowdown is not None:
+            lines.append('{:.1f}x the time of the reference solution'.format(self.slowdown))
+            if self.is_too_slow:
+                lines.append('the function is more than {}x slower than the reference solution. '
+                             'Consider vectorizing it'.format(Config.slowdown_limit))
+        return '\n'.join(lines)
 
 
 # UTILITY FUNCTIONS
+# HTTP
+_session = None
+
+
+def _get_session():
+    # a single session keeps the connections to the server alive between requests
+    global _session
+    if _session is None:
+        retry = requests.adapters.Retry(total=Config.retries,
+                                        backoff_factor=Config.backoff_factor,
+                                        status_forcelist=[502, 503, 504])
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def _get(endpoint, **kwargs):
+    return _get_session().get(endpoint, timeout=Config.timeout, **kwargs)
+
+
+def _post(endpoint, **kwargs):
+    return _get_session().post(endpoint, timeout=Config.timeout, **kwargs)
+
+
+# the last received progress of each user {username: (etag, data)}
+_progress_cache = {}
+
+
+def _get_progress(username):
+    # the server answers 304 Not Modified if the progress has not changed
+    endpoint = Config.host + 'get_progress/{}'.format(username)
+    headers = {}
+    if username in _progress_cache:
+        headers['If-None-Match'] = _progress_cache[username][0]
+    response = _get(endpoint, headers=headers)
+    if response.status_code == 304:
+        return _progress_cache[username][1]
+
+    data = response.json()
+    if 'error' in data:
+        raise ServerError(data['error'])
+    if 'ETag' in response.headers:
+        _progress_cache[username] = (response.headers['ETag'], data)
+    return data
+
+
 # Local tests
-def _remove_local_tests():
+# the manifest of the local tests {assignment: md5}, the last time it was received,
+# the etag and the manifest of the last response of `local_tests_manifest`
+# and the md5 and the parsed data of the local tests of each assignment
+_test_cache = {'manifest': {}, 'validated_at': None, 'etag': None, 'response': None,
+               'md5': {}, 'data': {}}
+
+
+def _test_path(assignment):
+    return os.path.join(Config.test_folder, assignment + automark_data.EXTENSION)
+
+
+def _test_cache_is_fresh():
+    validated_at = _test_cache['validated_at']
+    return validated_at is not None and time.time() - validated_at < Config.validation_ttl
+
+
+def _update_manifest(manifest, validated=False):
+    _test_cache['manifest'].update(manifest)
+    if validated:
+        _test_cache['validated_at'] = time.time()
+
+
+def _fetch_manifest():
+    # the server answers 304 Not Modified if the manifest has not changed
+    endpoint = Config.host + 'local_tests_manifest'
+    headers = {}
+    if _test_cache['etag'] is not None:
+        headers['If-None-Match'] = _test_cache['etag']
+    response = _get(endpoint, headers=headers)
+    if response.status_code == 304:
+        _update_manifest(_test_cache['response'], validated=True)
+        return
+
+    manifest = response.json()['assignments']
+    if 'ETag' in response.headers:
+        _test_cache['etag'], _test_cache['response'] = response.headers['ETag'], manifest
+    _update_manifest(manifest, validated=True)
+
+
+def _update_local_tests(username, assignments, refresh=False, manifest=None):
+    # downloads the local tests of the assignments which are missing or outdated
+    # the manifest sent with the inputs is up-to-date
+    is_up_to_date = manifest is not None
+    if manifest is not None:
+        _update_manifest(manifest)
+    elif refresh or not _test_cache_is_fresh():
+        _fetch_manifest()
+        is_up_to_date = True
+
+    for assignment in assignments:
+        if _test_cache['manifest'].get(assignment) is None and not is_up_to_date:
+            # the assignment may have been published after the manifest was received
+            _fetch_manifest()
+            is_up_to_date = True
+        server_md5 = _test_cache['manifest'].get(assignment)
+        if server_md5 is None:
+            raise ServerError("local tests for '{}' are not found.".format(assignment))
+        local_md5 = _local_md5(assignment)
+        if local_md5 != server_md5:
+            if local_md5 is not None:
+                _remove_local_tests(assignment)
+            print('Downloading local tests for {}...'.format(assignment))
+            _load_local_tests(username, assignment, server_md5)
+
+
+def _get_test_data(assignment):
+    if not assignment in _test_cache['data']:
+        _test_cache['data'][assignment] = automark_data.load(_test_path(assignment))
+    return _test_cache['data'][assignment]
+
+
+def _remove_local_tests(assignment):
+    _test_cache['md5'].pop(assignment, None)
+    _test_cache['data'].pop(assignment, None)
     try:
-        os.remove(Config.test_path)
-        print('The current version of local tests is outdated. The local tests are removed.')
+        os.remove(_test_path(assignment))
+        print('The current version of local tests for {} is outdated. '
+              'The local tests are removed.'.format(assignment))
         sys.stdout.flush()
     except FileNotFoundError:
         pass
 
 
-def _load_local_tests(username):
+def _load_local_tests(username, assignment, md5):
+    # the tests are downloaded to `<assignment>.amt.<md5>.part`. An interrupted download
+    # is resumed, also by the next call. The file is moved into place once its md5 is verified
+    _test_cache['md5'].pop(assignment, None)
+    _test_cache['data'].pop(assignment, None)
     if not os.path.exists(Config.test_folder):
         os.makedirs(Config.test_folder)
 
+    part_path = '{}.{}.part'.format(_test_path(assignment), md5)
+    for path in glob.glob(_test_path(assignment) + '.*.part'):
+        if path != part_path:
+            os.remove(path)
+
+    for attempt in range(Config.retries + 1):
+        try:
+            _download_local_tests(username, assignment, md5, part_path)
+            break
+        except Exception:
+            # `ServerError` is not an `Exception` and is raised as it is
+            if attempt == Config.retries:
+                raise ServerError('Error downloading local tests. '
+                                  'Run the test again to resume the download.')
+            time.sleep(Config.backoff_factor * 2 ** attempt)
+
+    _install_local_tests(assignment, md5, part_path)
+    print('Local tests are downloaded.')
+    sys.stdout.flush()
+
+
+def _download_local_tests(username, assignment, md5, part_path):
+    endpoint = Config.host + 'load_tests/{}/{}'.format(username, assignment)
+    params, headers = {}, {}
+    etag = md5
+    if Config.compression is not None:
+        params['compression'] = Config.compression
+        etag = md5 + '.gz'
+    size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if size > 0:
+        # the server sends the whole file if its version has changed
+        headers = {'Range': 'bytes={}-'.format(size), 'If-Range': '"{}"'.format(etag)}
+
+    stream = _get(endpoint, params=params, headers=headers, stream=True)
+    if stream.status_code == 416:
+        # the file is already downloaded
+        return
+    if not stream.status_code in (200, 206):
+        raise ServerError(stream.json()['error'])
+
+    with open(part_path, 'ab' if stream.status_code == 206 else 'wb') as f:
+        stream.raw.decode_content = True
+        for chunk in iter(lambda: stream.raw.read(64 * 1024), b""):
+            f.write(chunk)
+
+
+def _install_local_tests(assignment, md5, part_path):
+    tmp_path = _test_path(assignment) + '.tmp'
+    with open(part_path, 'rb') as f:
+        is_compressed = f.read(2) == b'\x1f\x8b'
+
+    hash_md5 = hashlib.md5()
     try:
-        endpoint = Config.host + 'load_tests/{}'.format(username)
-        stream = requests.get(endpoint, stream=True)
-        if stream.status_code == 200:
-            with open(Config.test_path, 'wb') as f:
-                stream.raw.decode_content = True
-                shutil.copyfileobj(stream.raw, f)
-            print('Local tests are downloaded.')
-            sys.stdout.flush()
-        else:
-            error = stream.json()['error']
-            raise ServerError(error)
-    except ServerError as e:
-        raise e
-    except:
-        raise ServerError('Error downloading local tests.')
+        with (gzip.open if is_compressed else open)(part_path, 'rb') as f_in:
+            with open(tmp_path, 'wb') as f_out:
+                for chunk in iter(lambda: f_in.read(64 * 1024), b""):
+                    hash_md5.update(chunk)
+                    f_out.write(chunk)
+    except (EnvironmentError, EOFError, zlib.error):
+        pass
+    os.remove(part_path)
+
+    if hash_md5.hexdigest() != md5:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        # the tests may have changed on the server after the manifest was received
+        _test_cache['validated_at'] = None
+        raise ServerError('The downloaded local tests are corrupted. Please, run the test again.')
+    _replace(tmp_path, _test_path(assignment))
+    _test_cache['md5'][assignment] = md5
+
+
+def _replace(src, dst):
+    # `os.replace` is not available in Python 2
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
 
 
-def _local_tests_are_valid():
-    try:
+def _local_md5(assignment):
+    # returns None if there are no local tests for the assignment
+    if not assignment in _test_cache['md5']:
         hash_md5 = hashlib.md5()
-        with open(Config.test_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        local_md5 = hash_md5.hexdigest()
-        endpoint = Config.host + 'check_sum/{}'.format(local_md5)
-        response = requests.get(endpoint).json()
-        return response['success']
-    except:
-        return False
-
-
-def _passed_local_tests(function, arg_keys):
-    with open(Config.test_path, 'rb') as f:
         try:
-            test_data = pickle.load(f, encoding='latin1')
-        except TypeError:
-            test_data = pickle.load(f)
+            with open(_test_path(assignment), "rb") as f:
+                for chunk in iter(lambda: f.read(4096), b""):
+                    hash_md5.update(chunk)
+        except EnvironmentError:
+            return None
+        _test_cache['md5'][assignment] = hash_md5.hexdigest()
+    return _test_cache['md5'][assignment]
+
 
-    data = test_data[function.__name__]
+def _run_local_tests(function, arg_keys, workers=None, case_timeout=None, profile=None):
+    workers = Config.workers if workers is None else workers
+    case_timeout = Config.case_timeout if case_timeout is None else case_timeout
+    profile = Config.profile if profile is None else profile
+
+    data = _get_test_data(function.__name__)
     inputs = data['inputs']
     outputs = data['outputs']
-
-    for in_, out_ in zip(inputs, outputs):
-        args_ = {k: in_[k] for k in arg_keys}
+    report = LocalTestReport(len(inputs))
+    if 'reference_times' in data:
+        report.reference_times = [float(t) for t in data['reference_times']]
+
+    # the time when each test case started, the timeouts are measured from it
+    started = [None] * len(inputs)
+
+    def run_case(idx):
+        # the cached test data is read-only, the function gets copies of the arrays
+        started[idx] = _timer()
+        args_ = {k: np.array(inputs[idx][k]) if isinstance(inputs[idx][k], np.ndarray)
+                 else inputs[idx][k] for k in arg_keys}
+        start = _timer()
         answer = function(**args_)
-        if not np.allclose(answer, out_, rtol=1e-5, atol=1e-5):
-            return False
-    return True
+        return answer, _timer() - start
+
+    answers = [None] * len(inputs)
+    timed_out, crashed, not_run = set(), set(), set()
+    if profile:
+        # the test cases are run one by one, as the CPU time and the memory are per process
+        for idx in range(len(inputs)):
+            answers[idx], report.times[idx], report.cpu_times[idx], report.peak_memory[idx] = \
+                _profile_case(run_case, idx)
+    elif workers <= 1 and case_timeout is None:
+        for idx in range(len(inputs)):
+            answers[idx], report.times[idx] = run_case(idx)
+    elif case_timeout is not None and _fork_context() is not None:
+        results, timed_out, crashed = _run_cases_in_processes(run_case, len(inputs),
+                                                              max(workers, 1), case_timeout)
+        for idx, (answer, case_time) in results.items():
+            answers[idx], report.times[idx] = answer, case_time
+    else:
+        # the threads of the timed out test cases can not be stopped, they are abandoned
+        workers = max(workers, 1)
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(run_case, (idx,)) for idx in range(len(inputs))]
+            for idx, result in enumerate(results):
+                # the test case waits for a free thread unless all of them are hung
+                while started[idx] is None and not result.ready():
+                    if sum(not results[i].ready() for i in timed_out) >= workers:
+                        break
+                    result.wait(0.01)
+                if started[idx] is None and not result.ready():
+                    not_run.add(idx)
+                    continue
+                if case_timeout is None:
+                    result.wait()
+                else:
+                    result.wait(max(case_timeout - (_timer() - started[idx]), 0.0))
+                try:
+                    answers[idx], report.times[idx] = result.get(0.0)
+                except TimeoutError:
+                    timed_out.add(idx)
+        finally:
+            pool.terminate()
+
+    failures = {idx: 'timeout of {} sec'.format(case_timeout) for idx in timed_out}
+    failures.update({idx: 'the process of the test case exited' for idx in crashed})
+    completed = [idx for idx in range(len(inputs)) if not idx in failures and not idx in not_run]
+    failures.update(_compare_outputs([answers[idx] for idx in completed],
+                                     [outputs[idx] for idx in completed],
+                                     completed, report, data.get('comparator')))
+
+    report.n_not_run = len(not_run)
+    report.n_passed = report.n_cases - len(failures) - len(not_run)
+    if failures:
+        report.first_failure = min(failures)
+        report.failure_reason = failures[report.first_failure]
+    return report
+
+
+def _fork_context():
+    # the forked processes inherit the tested function, which may not be picklable
+    if not hasattr(os, 'fork'):
+        return None
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _case_worker(conn, run_case):
+    # runs the test cases sent by the parent until it sends `None`
+    while True:
+        idx = conn.recv()
+        if idx is None:
+            return
+        try:
+            conn.send((idx, run_case(idx), None))
+        except Exception as e:
+            conn.send((idx, None, e))
+
+
+def _run_cases_in_processes(run_case, n_cases, workers, case_timeout):
+    # returns {index: (answer, time)}, the timed out and the crashed test cases
+    # a test case is sent to an idle process, which is killed if the test case times out
+    context = _fork_context()
+    pending = list(range(n_cases))[::-1]
+    idle, busy = [], {}
+    results, timed_out, crashed = {}, set(), set()
+
+    def start_worker():
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_case_worker, args=(child_conn, run_case))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        idle.append((parent_conn, process))
+
+    def stop_worker(conn, process):
+        conn.close()
+        getattr(process, 'kill', process.terminate)()
+        process.join()
+
+    try:
+        for _ in range(min(workers, n_cases)):
+            start_worker()
+        while pending or busy:
+            while pending and idle:
+                conn, process = idle.pop()
+                idx = pending.pop()
+                conn.send(idx)
+                busy[conn] = (process, idx, _timer() + case_timeout)
+
+            timeout = max(min(deadline for _, _, deadline in busy.values()) - _timer(), 0.0)
+            for conn in select.select(list(busy), [], [], timeout)[0]:
+                process, idx, _ = busy.pop(conn)
+                try:
+                    idx, result, error = conn.recv()
+                except EOFError:
+                    crashed.add(idx)
+                    stop_worker(conn, process)
+                    start_worker()
+                    continue
+                if error is not None:
+                    raise error
+                results[idx] = result
+                idle.append((conn, process))
+
+            now = _timer()
+            for conn in [conn for conn, (_, _, deadline) in busy.items() if deadline <= now]:
+                process, idx, _ = busy.pop(conn)
+                timed_out.add(idx)
+                stop_worker(conn, process)
+                if pending:
+                    start_worker()
+    finally:
+        for conn, process in idle + [(conn, entry[0]) for conn, entry in busy.items()]:
+            stop_worker(conn, process)
+    return results, timed_out, crashed
+
+
+def _profile_case(run_case, idx):
+    # returns the answer, the wall time, the CPU time and the peak memory of the test case
+    # the memory is measured in a separate run, as tracing slows down the function
+    start_cpu = _cpu_timer()
+    answer, wall_time = run_case(idx)
+    cpu_time = _cpu_timer() - start_cpu
+
+    peak_memory = None
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        try:
+            run_case(idx)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return answer, wall_time, cpu_time, peak_memory
+
+
+def _compare_outputs(answers, outputs, indices, report, comparator=None):
+    # returns {index: reason} of the failed test cases and updates the errors in the report
+    failures = {}
+    if not indices:
+        return failures
+
+    reasons = automark_compare.compare_many(answers, outputs, comparator)
+    for idx, reason in zip(indices, reasons):
+        if reason is not None:
+            failures[idx] = reason
+
+    abs_error, rel_error = _max_errors(answers, outputs)
+    report.max_abs_error = max(report.max_abs_error, abs_error)
+    report.max_rel_error = max(report.max_rel_error, rel_error)
+    return failures
+
+
+def _max_errors(answers, outputs):
+    # the errors are measured for the numeric answers of the same shape as the outputs
+    pairs = []
+    for answer, output in zip(answers, outputs):
+        answer, output = _numeric_array(answer), _numeric_array(output)
+        if answer is None or output is None or answer.shape != output.shape:
+            continue
+        if answer.dtype.kind in 'iufc' and output.dtype.kind in 'iufc':
+            pairs.append((answer, output))
+    if not pairs:
+        return 0.0, 0.0
+    if len(set(answer.shape for answer, _ in pairs)) == 1:
+        # all test cases are measured in one vectorized pass
+        return _errors(np.stack([answer for answer, _ in pairs]),
+                       np.stack([output for _, output in pairs]))
+    errors = [_errors(answer, output) for answer, output in pairs]
+    return max(error[0] for error in errors), max(error[1] for error in errors)
+
+
+def _errors(answer, output):
+    # returns the maximum absolute and relative errors
+    if answer.size == 0:
+        return 0.0, 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        abs_error = np.abs(answer - output)
+        rel_error = abs_error / np.abs(output)
+    return float(np.nanmax(abs_error)), float(np.nanmax(np.where(abs_error == 0, 0, rel_error)))
 
 
 # Remote tests
 def _passed_remote_test(username, function, arg_keys):
     endpoint = Config.host + 'get_test_input/{}/{}'.format(username, function.__name__)
-    response = requests.get(endpoint)
+    response = _get(endpoint)
     data = response.json()
 
     if 'error' in data:
         raise ServerError(data['error'])
 
+    test_result = function(*_parse_input(data['input'], arg_keys))
+    endpoint = Config.host + 'check_answer/{}/{}/{}'.format(username, function.__name__,
+                                                            data['ipd'])
+    body, headers = _encode_answer(test_result)
+    response = _post(endpoint, data=body, headers=headers)
+
+    if not response.status_code == 200:
+        raise ServerError('Internal Error Occurred')
+    answer_response = response.json()
+
+    return answer_response['success']
+
+
+def _numeric_array(answer):
+    # returns None if the answer is not a numeric array, e.g. a tuple or a dict
+    if isinstance(answer, (tuple, dict)):
+        return None
+    try:
+        array = np.asarray(answer)
+    except (TypeError, ValueError):
+        return None
+    return array if array.dtype.kind in 'biufc' else None
+
+
+def _encode_answer(answer):
+    # the numeric arrays are sent as raw buffers, the other answers as json
+    array = _numeric_array(answer)
+    if array is not None:
+        return _encode_array(array)
+    body = json.dumps(automark_compare.to_json(answer))
+    return body, {'Content-Type': 'application/json'}
+
+
+def _encode_array(array):
+    array = array.astype(array.dtype.newbyteorder('<'), order='C', copy=False)
+    headers = {
+        'Content-Type': 'application/octet-stream',
+        'X-Dtype': array.dtype.str,
+        'X-Shape': ','.join(str(dim) for dim in array.shape),
+    }
+    return array.tobytes(), headers
+
+
+def _parse_input(input_, arg_keys):
     args = []
     for key in arg_keys:
-        arg_ = data['input'][key]
-        arg_value = data['input'][key]['data']
+        arg_ = input_[key]
+        arg_value = input_[key]['data']
         if arg_['type'] == 'ndarray':
             arg_value = np.array(arg_value)
         args.append(arg_value)
+    return args
 
-    test_result = function(*args)
-    test_result = np.array(test_result).tolist()
-    endpoint = Config.host
-    endpoint += 'check_answer/{}/{}/{}/{}'.format(username, function.__name__,
-                                                  data['ipd'], json.dumps(test_result))
 
-    response = requests.get(endpoint)
-    if not response.status_code == 200:
-        raise ServerError('Internal Error Occurred')
-    answer_response = response.json()
+def _get_test_inputs(username, assignments):
+    # gets the inputs and the md5 of the local tests for all assignments at once
+    endpoint = Config.host + 'get_test_inputs/{}/{}'.format(username, ','.join(assignments))
+    data = _get(endpoint).json()
+    if 'error' in data:
+        raise ServerError(data['error'])
+    return data
 
-    return answer_response['success']
+
+def _check_answers(username, answers):
+    endpoint = Config.host + 'check_answers/{}'.format(username)
+    headers = {'Content-Type': 'application/octet-stream'}
+    response = _post(endpoint, data=_encode_answers(answers), headers=headers)
+    data = response.json()
+    if 'error' in data:
+        raise ServerError(data['error'])
+    return data['success']
+
+
+def _encode_answers(answers):
+    # <uint32 header length><json header><raw little-endian buffers>
+    header, buffers = [], []
+    for assignment, ipd, answer in answers:
+        array = _numeric_array(answer)
+        if array is None:
+            header.append({
+                'assignment': assignment,
+                'ipd': ipd,
+                'json': automark_compare.to_json(answer),
+            })
+            continue
+        array = array.astype(array.dtype.newbyteorder('<'), order='C', copy=False)
+        header.append({
+            'assignment': assignment,
+            'ipd': ipd,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+        })
+        buffers.append(array.tobytes())
+    header = json.dumps(header).encode('utf-8')
+    return b''.join([struct.pack('<I', len(header)), header] + buffers)
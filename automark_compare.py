@@ -0,0 +1,241 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This module compares the answers of the students with the ground truth.
+It is shared by the client and the server, so the local and the remote
+tests give the same verdicts.
+
+The comparator of an assignment is set by the "comparator" field of its
+test data: a name or `{"name": .., <options>}`. By default it is "auto":
+    dict            the same keys, each value is compared with "auto"
+    tuple           the same number of items, each item is compared with "auto"
+    numeric array   "allclose"
+    other values    "equal"
+The options of "auto" are passed to the comparators of the items.
+
+    allclose    the same shape and a compatible dtype, then all values are close:
+                rtol, atol, equal_nan, exact_dtype, chunk_size
+    equal       the same shape and equal values
+    tuple       items - a list of the comparators of the items
+    dict        items - {key: comparator}
+
+The large arrays are compared by chunks of `chunk_size` values, the comparison
+stops at the first chunk with a wrong value. New comparators are added with
+`register`. A comparator returns None if the answer is correct and
+the reason why it is wrong otherwise. An unknown comparator is reported
+as the reason instead of raising, so a misconfigured assignment fails
+its test cases instead of the request.
+
+Compatible with Python 2/3
+"""
+
+import numpy as np
+
+
+CHUNK_SIZE = 1 << 20
+COMPARATORS = {}
+
+
+def register(name):
+    "Register the decorated function as the comparator `name`"
+    def decorator(comparator):
+        COMPARATORS[name] = comparator
+        return comparator
+    return decorator
+
+
+def compare(answer, output, comparator=None):
+    """Compare the answer with the ground truth output
+    # Args:
+        answer - the answer of the student
+        output - the ground truth output
+        comparator - the comparator of the assignment, see above
+    # Output:
+        None if the answer is correct, otherwise the reason why it is wrong
+    """
+    try:
+        name, options = _parse(comparator)
+    except ValueError as e:
+        return str(e)
+    try:
+        return COMPARATORS[name](answer, output, **options)
+    except (TypeError, ValueError, KeyError, IndexError) as e:
+        return 'the answer can not be compared with the output: {}'.format(e)
+
+
+def is_correct(answer, output, comparator=None):
+    return compare(answer, output, comparator) is None
+
+
+def compare_many(answers, outputs, comparator=None):
+    """Compare the answers of several test cases
+    The arrays of the same shape are compared in one vectorized pass.
+    # Output:
+        a list of the results of `compare`
+    """
+    try:
+        name, options = _parse(comparator)
+    except ValueError as e:
+        return [str(e)] * len(answers)
+    if name in ('auto', 'allclose') and answers and _can_stack(answers, outputs, options):
+        answers, outputs = np.stack(answers), np.stack(outputs)
+        close = _isclose(answers, outputs, options).reshape(len(answers), -1).all(axis=1)
+        return [None if case_is_close else 'wrong answer' for case_is_close in close]
+    return [compare(answer, output, comparator) for answer, output in zip(answers, outputs)]
+
+
+def to_json(value):
+    "Utility function to convert an answer to json-compatible values"
+    if isinstance(value, dict):
+        return {str(k): to_json(v) for k, v in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [to_json(v) for v in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+##############
+# comparators
+##############
+@register('auto')
+def compare_auto(answer, output, **options):
+    if isinstance(output, dict):
+        return compare_dict(answer, output, **options)
+    if isinstance(output, tuple):
+        return compare_tuple(answer, output, **options)
+    if _is_numeric(np.asarray(output)):
+        return compare_allclose(answer, output, **options)
+    return compare_equal(answer, output)
+
+
+@register('allclose')
+def compare_allclose(answer, output, rtol=1e-5, atol=1e-5, equal_nan=False,
+                     exact_dtype=False, chunk_size=CHUNK_SIZE):
+    answer, output = np.asarray(answer), np.asarray(output)
+    reason = _check_shape(answer, output)
+    if reason is not None:
+        return reason
+    if not _is_numeric(output):
+        return 'the output of dtype {} is not numeric'.format(output.dtype)
+    if not _dtype_is_compatible(answer.dtype, output.dtype, exact_dtype):
+        return 'the answer of dtype {} does not match the output of dtype {}'.format(
+            answer.dtype, output.dtype)
+
+    options = {'rtol': rtol, 'atol': atol, 'equal_nan': equal_nan}
+    answer, output = answer.reshape(-1), output.reshape(-1)
+    for start in range(0, answer.size, chunk_size):
+        stop = start + chunk_size
+        if not _isclose(answer[start:stop], output[start:stop], options).all():
+            return 'wrong answer'
+    return None
+
+
+@register('equal')
+def compare_equal(answer, output, **options):
+    answer, output = np.asarray(answer), np.asarray(output)
+    reason = _check_shape(answer, output)
+    if reason is not None:
+        return reason
+    if not np.array_equal(answer, output):
+        return 'wrong answer'
+    return None
+
+
+@register('tuple')
+def compare_tuple(answer, output, items=None, **options):
+    # the answers sent as json have lists instead of tuples
+    if not isinstance(answer, (tuple, list)):
+        return 'the answer is a {} instead of a tuple'.format(type(answer).__name__)
+    if len(answer) != len(output):
+        return 'the answer has {} items instead of {}'.format(len(answer), len(output))
+    for idx, (answer_item, output_item) in enumerate(zip(answer, output)):
+        comparator = items[idx] if items is not None else dict(options, name='auto')
+        reason = compare(answer_item, output_item, comparator)
+        if reason is not None:
+            return 'item {}: {}'.format(idx, reason)
+    return None
+
+
+@register('dict')
+def compare_dict(answer, output, items=None, **options):
+    if not isinstance(answer, dict):
+        return 'the answer is a {} instead of a dict'.format(type(answer).__name__)
+    # the keys of the answers sent as json are strings
+    answer = {str(k): v for k, v in answer.items()}
+    output = {str(k): v for k, v in output.items()}
+    if set(answer) != set(output):
+        return 'the answer has the keys {} instead of {}'.format(sorted(answer), sorted(output))
+    for key in sorted(output):
+        comparator = items[key] if items is not None else dict(options, name='auto')
+        reason = compare(answer[key], output[key], comparator)
+        if reason is not None:
+            return 'key {!r}: {}'.format(key, reason)
+    return None
+
+
+##############
+# helpers
+##############
+def _parse(comparator):
+    # returns the name and the options of the comparator
+    if comparator is None:
+        return 'auto', {}
+    if not isinstance(comparator, dict):
+        comparator = {'name': comparator}
+    options = dict((str(k), v) for k, v in comparator.items())
+    name = options.pop('name', 'auto')
+    if not name in COMPARATORS:
+        raise ValueError('unknown comparator: {}'.format(name))
+    return name, options
+
+
+def _is_numeric(array):
+    return array.dtype.kind in 'iufc'
+
+
+def _dtype_is_compatible(answer_dtype, output_dtype, exact_dtype):
+    # integer answers are accepted for real outputs, real answers for complex outputs
+    if exact_dtype:
+        return answer_dtype == output_dtype
+    return answer_dtype.kind in {'i': 'iu', 'u': 'iu', 'f': 'iuf', 'c': 'iufc'}[output_dtype.kind]
+
+
+def _check_shape(answer, output):
+    # the answers are never broadcast to the shape of the output
+    if answer.shape != output.shape:
+        return 'the answer of shape {} does not match the output of shape {}'.format(
+            answer.shape, output.shape)
+    return None
+
+
+def _isclose(answer, output, options):
+    return np.isclose(answer, output, rtol=options.get('rtol', 1e-5),
+                      atol=options.get('atol', 1e-5), equal_nan=options.get('equal_nan', False))
+
+
+def _can_stack(answers, outputs, options):
+    # the fast path gives the same verdicts as `compare_allclose` for each test case
+    arrays = [x for x in list(answers) + list(outputs) if isinstance(x, np.ndarray)]
+    if len(arrays) != len(answers) + len(outputs) or len(set(x.shape for x in arrays)) != 1:
+        return False
+    return all(output.dtype.kind in 'iuf' and
+               _dtype_is_compatible(answer.dtype, output.dtype, options.get('exact_dtype', False))
+               for answer, output in zip(answers, outputs))
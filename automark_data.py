@@ -0,0 +1,212 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This module reads and writes the test data of AutoMark.
+
+The test data of one assignment is stored in a single `.amt` file:
+    magic           8 bytes, `AMTESTS1`
+    header size     uint64, little-endian
+    header          json, {"arrays": [{"dtype": .., "shape": [..], "offset": ..}, ...],
+                           "data": <the test data with the arrays replaced by references>}
+    data region     the raw little-endian arrays, each aligned to 64 bytes
+
+The data region is opened with `np.memmap`, so loading a file does not read
+the arrays and the pages are shared by all processes which open the file.
+The arrays are read-only.
+
+Large files can be written incrementally with `Writer`, without holding
+all arrays in memory.
+
+In the header, the arrays are replaced with `{"__ndarray__": index}` and
+the tuples with `{"__tuple__": [...]}`. Other values are stored as json.
+
+Compatible with Python 2/3
+"""
+
+import os
+import json
+import shutil
+import struct
+import numpy as np
+
+
+MAGIC = b'AMTESTS1'
+ALIGNMENT = 64
+EXTENSION = '.amt'
+
+
+def save(path, data):
+    """Write the test data of an assignment to `path`
+    # Args:
+        path - the path of the file
+        data - a structure of dicts, lists, tuples, scalars and numpy arrays
+    """
+    arrays = []
+    encoded = _encode(data, arrays)
+
+    entries, offset = [], 0
+    for array in arrays:
+        offset = _align(offset)
+        entries.append({'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset += array.nbytes
+
+    header = json.dumps({'arrays': entries, 'data': encoded}).encode('utf-8')
+    data_offset = _align(len(MAGIC) + 8 + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_offset - f.tell()))
+        for array, entry in zip(arrays, entries):
+            f.write(b'\0' * (data_offset + entry['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+
+class Writer:
+    """Write the test data of an assignment to `path` incrementally
+
+    The arrays are written to `<path>.data` as soon as they are added,
+    only the header is kept in memory. `close` writes the file in the same
+    format as `save` and removes `<path>.data`.
+
+        writer = Writer(path)
+        for inputs, output in cases:
+            writer.append('inputs', inputs)
+            writer.append('outputs', output)
+        writer.set('reference_times', times)
+        writer.close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = {}
+        self._arrays = _ArrayStream(open(path + '.data', 'wb'))
+
+    def set(self, key, value):
+        self._data[key] = _encode(value, self._arrays)
+
+    def append(self, key, value):
+        self._data.setdefault(key, []).append(_encode(value, self._arrays))
+
+    def close(self):
+        self._arrays.f.close()
+        header = json.dumps({'arrays': self._arrays.entries, 'data': self._data}).encode('utf-8')
+        data_offset = _align(len(MAGIC) + 8 + len(header))
+
+        with open(self.path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (data_offset - f.tell()))
+            with open(self.path + '.data', 'rb') as data_file:
+                shutil.copyfileobj(data_file, f, 1024 * 1024)
+        os.remove(self.path + '.data')
+
+
+class _ArrayStream:
+    # used by `_encode` as the list of arrays, writes them to the data region
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, array):
+        offset = _align(self.f.tell())
+        self.f.write(b'\0' * (offset - self.f.tell()))
+        self.f.write(array.tobytes())
+        self.entries.append({'dtype': array.dtype.str, 'shape': list(array.shape),
+                             'offset': offset})
+
+
+def load(path, mmap=True):
+    """Read the test data of an assignment from `path`
+    # Args:
+        path - the path of the file
+        mmap - if `True`, the arrays are memory-mapped, otherwise they are read to memory
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a file of AutoMark tests.'.format(path))
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        data_offset = _align(len(MAGIC) + 8 + header_size)
+
+        entries = header['arrays']
+        size = max([_end_of(entry) for entry in entries] + [0])
+        if mmap and size > 0:
+            region = np.memmap(path, dtype=np.uint8, mode='r', offset=data_offset, shape=(size,))
+        else:
+            f.seek(data_offset)
+            region = np.frombuffer(f.read(size), dtype=np.uint8)
+
+    arrays = []
+    for entry in entries:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        array = np.frombuffer(region, dtype=dtype, count=count, offset=entry['offset'])
+        arrays.append(array.reshape(entry['shape']))
+    return _decode(header['data'], arrays)
+
+
+def is_test_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _end_of(entry):
+    count = int(np.prod(entry['shape']))
+    return entry['offset'] + count * np.dtype(entry['dtype']).itemsize
+
+
+def _encode(value, arrays):
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError('arrays of objects are not supported.')
+        arrays.append(value.astype(value.dtype.newbyteorder('<'), order='C', copy=False))
+        return {'__ndarray__': len(arrays) - 1}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {str(k): _encode(v, arrays) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(v, arrays) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v, arrays) for v in value]
+    return value
+
+
+def _decode(value, arrays):
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            return arrays[value['__ndarray__']]
+        if '__tuple__' in value:
+            return tuple(_decode(v, arrays) for v in value['__tuple__'])
+        return {k: _decode(v, arrays) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    return value
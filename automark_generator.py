@@ -0,0 +1,273 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This module generates the local and the remote tests of assignments.
+
+An assignment is described by its ground truth function and the
+specification of its inputs:
+
+    matmul = Assignment('matmul', gt_matmul,
+                        inputs={'A': Array(('n1', 'n2')), 'B': Array(('n2', 'n3'))},
+                        dims={'n1': (1, 6), 'n2': (1, 6), 'n3': (1, 6)})
+    generate([matmul], '../automark_server/assignments', seed=0)
+
+The sizes of the named dimensions are sampled for each test case, so the
+arrays of a test case have consistent shapes. The values of all arrays of
+a chunk of test cases are sampled at once.
+
+The chunks are generated by a pool of processes. Each chunk has its own
+`np.random.Generator` seeded with (seed, assignment, suite, first test case),
+so the inputs and the outputs only depend on the seed and the chunk size,
+not on the number of processes. The chunks are written to the `.amt` files in order as soon
+as they are ready, so only a few chunks are kept in memory.
+
+The ground truth functions must be defined at the top level of a module,
+as they are sent to the processes. The local tests contain the
+"reference_times" of the ground truth function, which are measured in the
+processes and are therefore slightly pessimistic. They differ between runs,
+so the regenerated local tests have a new md5 even with the same seed and
+the clients download them again.
+"""
+
+import os
+import zlib
+import pickle
+import timeit
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import automark_data
+
+SUITES = ('local', 'remote')
+
+
+class Array:
+    """The specification of an input array
+    # Args:
+        shape - a tuple of ints and names of the dimensions from `Assignment.dims`
+        low, high - the range of the values. Floats are sampled from [low, high),
+            integers from [low, high]
+        dtype - the dtype of the array
+    """
+
+    def __init__(self, shape=(), low=-10.0, high=10.0, dtype='float64'):
+        self.shape = tuple(shape)
+        self.low = low
+        self.high = high
+        self.dtype = np.dtype(dtype)
+
+    def sample(self, rng, size):
+        if self.dtype.kind in 'iu':
+            return rng.integers(self.low, self.high, size=size, dtype=self.dtype, endpoint=True)
+        return rng.uniform(self.low, self.high, size=size).astype(self.dtype, copy=False)
+
+
+class Assignment:
+    """The specification of an assignment
+    # Args:
+        name - the name of the assignment, i.e. of the student's function
+        gt_function - the ground truth function, it is called with the inputs as keyword arguments
+        inputs - {argument: Array}
+        dims - {dimension: (min, max)}, the range of the size of each named dimension
+        n_local - the number of local test cases
+        n_remote - the number of remote test cases
+        comparator - the comparator of the answers, see `automark_compare.py`.
+            "auto" by default
+    """
+
+    def __init__(self, name, gt_function, inputs, dims=None, n_local=100, n_remote=100,
+                 comparator=None):
+        self.name = name
+        self.gt_function = gt_function
+        self.inputs = inputs
+        self.dims = dims or {}
+        self.n_cases = {'local': n_local, 'remote': n_remote}
+        self.comparator = comparator
+
+    def sample_inputs(self, rng, n):
+        # returns a list of `n` dicts of inputs
+        sizes = {name: rng.integers(low, high, size=n, endpoint=True)
+                 for name, (low, high) in sorted(self.dims.items())}
+        cases = [{} for _ in range(n)]
+        for argument, spec in sorted(self.inputs.items()):
+            shapes = np.zeros((n, 0), dtype=np.int64)
+            if spec.shape:
+                shapes = np.stack([sizes[dim] if dim in sizes else np.full(n, dim)
+                                   for dim in spec.shape], axis=1)
+            counts = shapes.prod(axis=1)
+            values = spec.sample(rng, int(counts.sum()))
+            for case, chunk, shape in zip(cases, np.split(values, np.cumsum(counts)[:-1]), shapes):
+                case[argument] = chunk.reshape(tuple(shape))
+        return cases
+
+
+def generate(assignments, assignments_dir, seed=0, processes=None, chunk_size=1000,
+             fmt='amt', repeat=5):
+    """Generate the local and the remote tests of the assignments
+    # Args:
+        assignments - a list of `Assignment`
+        assignments_dir - the `assignments` folder of the server
+        seed - the seed of all random generators
+        processes - the number of processes, all CPUs by default
+        chunk_size - the number of test cases generated at once by a process
+        fmt - 'amt' or 'pickle'. The legacy `.pickle` files are written at once
+        repeat - the number of runs of the ground truth function to measure the reference times
+    """
+    processes = processes or os.cpu_count() or 1
+    sinks = collections.OrderedDict()
+    tasks = []
+    for assignment in assignments:
+        for suite in SUITES:
+            n_cases = assignment.n_cases[suite]
+            sink = _AmtSink if fmt == 'amt' else _DictSink
+            sinks[(assignment.name, suite)] = sink(assignment, suite, seed, assignments_dir)
+            if assignment.comparator is not None:
+                sinks[(assignment.name, suite)].set('comparator', assignment.comparator)
+            for start in range(0, n_cases, chunk_size):
+                stop = min(start + chunk_size, n_cases)
+                tasks.append((assignment, suite, seed, start, stop, repeat))
+
+    if processes == 1:
+        for task in tasks:
+            sinks[(task[0].name, task[1])].write(*_generate_chunk(*task))
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            # the results are written in order, at most 2 chunks per process are pending
+            pending = collections.deque()
+            for task in tasks:
+                pending.append((task, pool.submit(_generate_chunk, *task)))
+                if len(pending) >= 2 * processes:
+                    task, future = pending.popleft()
+                    sinks[(task[0].name, task[1])].write(*future.result())
+            for task, future in pending:
+                sinks[(task[0].name, task[1])].write(*future.result())
+
+    for sink in sinks.values():
+        sink.close()
+
+    if fmt == 'pickle':
+        for suite in SUITES:
+            tests = {name: sink.data for (name, sink_suite), sink in sinks.items()
+                     if sink_suite == suite}
+            if suite == 'remote':
+                tests = pack_remote_tests(tests)
+            with open(os.path.join(assignments_dir, suite + '_tests.pickle'), 'wb') as f:
+                pickle.dump(tests, f, protocol=2)
+    else:
+        # the legacy files would take precedence on the server
+        for filename in ['local_tests.pickle', 'remote_tests.pickle']:
+            if os.path.exists(os.path.join(assignments_dir, filename)):
+                os.remove(os.path.join(assignments_dir, filename))
+
+
+def _seed_sequence(seed, name, *keys):
+    return np.random.SeedSequence([seed, zlib.crc32(name.encode('utf-8'))] + list(keys))
+
+
+def _generate_chunk(assignment, suite, seed, start, stop, repeat):
+    rng = np.random.default_rng(_seed_sequence(seed, assignment.name, SUITES.index(suite), start))
+    inputs = assignment.sample_inputs(rng, stop - start)
+    outputs = [assignment.gt_function(**args) for args in inputs]
+    times = reference_times(assignment.gt_function, inputs, repeat) if suite == 'local' else None
+    return inputs, outputs, times
+
+
+def reference_times(gt_function, inputs, repeat=5):
+    "Utility function to measure the best wall time of the ground truth function per test case"
+    times = []
+    for args in inputs:
+        timer = timeit.Timer(lambda: gt_function(**args))
+        times.append(min(timer.repeat(repeat=repeat, number=1)))
+    return np.array(times)
+
+
+def crdict(data):
+    "Utility function to pack arrays"
+    data_type = type(data).__name__
+    if data_type == 'ndarray':
+        return {'data': data.tolist(), 'type': data_type}
+    else:
+        return {'data': data, 'type': data_type}
+
+
+def pack_remote_tests(remote_tests):
+    "Utility function to pack the inputs of the remote tests for the legacy format"
+    for data_dict in remote_tests.values():
+        data_dict['inputs'] = [{k: crdict(v) for k, v in inputs.items()}
+                               for inputs in data_dict['inputs']]
+    return remote_tests
+
+
+class _DictSink:
+    # collects the tests of an assignment in memory
+
+    def __init__(self, assignment, suite, seed, assignments_dir):
+        self.data = {}
+        self.times = []
+        self._ipds = None
+        if suite == 'remote':
+            # the identifiers of the test cases are unique random numbers
+            n_cases = assignment.n_cases[suite]
+            rng = np.random.default_rng(_seed_sequence(seed, assignment.name, len(SUITES)))
+            self._ipds = iter(rng.choice(max(10000, n_cases), n_cases, replace=False).tolist())
+
+    def write(self, inputs, outputs, times):
+        for args, output in zip(inputs, outputs):
+            self.append('inputs', args)
+            self.append('outputs', output)
+            if self._ipds is not None:
+                self.append('ipd', next(self._ipds))
+        if times is not None:
+            self.times.append(times)
+
+    def append(self, key, value):
+        self.data.setdefault(key, []).append(value)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def close(self):
+        if self.times:
+            self.set('reference_times', np.concatenate(self.times))
+
+
+class _AmtSink(_DictSink):
+    # streams the tests of an assignment to `<suite>_tests/<assignment>.amt`
+
+    def __init__(self, assignment, suite, seed, assignments_dir):
+        _DictSink.__init__(self, assignment, suite, seed, assignments_dir)
+        tests_dir = os.path.join(assignments_dir, suite + '_tests')
+        if not os.path.exists(tests_dir):
+            os.makedirs(tests_dir)
+        self.path = os.path.join(tests_dir, assignment.name + automark_data.EXTENSION)
+        self.writer = automark_data.Writer(self.path + '.tmp')
+
+    def append(self, key, value):
+        self.writer.append(key, value)
+
+    def set(self, key, value):
+        self.writer.set(key, value)
+
+    def close(self):
+        _DictSink.close(self)
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
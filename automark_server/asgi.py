@@ -0,0 +1,420 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This script runs the server application of AutoMark as an ASGI application.
+
+It serves the same routes as `main.py` with the same wrappers and shares
+its state (`main.Global`). The requests are handled by a single event loop,
+so a connection costs a coroutine instead of a thread:
+    - the local tests are streamed in chunks, a slow client only holds
+      a chunk in memory. Range requests are supported;
+    - the answers are compared in a pool of threads;
+    - the calls which read files or the shared database run in
+      the default executor.
+
+It requires an ASGI server, e.g. uvicorn:
+    python asgi.py
+    AUTOMARK_WORKERS=4 python asgi.py
+The environment variables are the same as for `main.py`.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import re
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import numpy as np
+
+import main
+import utils
+import wrappers
+from main import Global
+
+CHUNK_SIZE = 64 * 1024
+# the answers are compared outside of the event loop
+COMPARE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+ROUTES = []
+
+
+class Request:
+
+    def __init__(self, scope, receive, rule):
+        self.scope = scope
+        self.receive = receive
+        self.rule = rule
+        self.method = scope['method']
+        self.args = {key: values[-1] for key, values in
+                     parse_qs(scope.get('query_string', b'').decode('latin1')).items()}
+        self.headers = {key.decode('latin1').lower(): value.decode('latin1')
+                        for key, value in scope['headers']}
+        # the content type without the parameters, as in flask
+        self.mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+    async def get_data(self):
+        chunks = []
+        while True:
+            message = await self.receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+
+class Response:
+
+    def __init__(self, body=b'', status=200, content_type='application/json'):
+        self.body = body
+        self.status = status
+        self.headers = [(b'content-type', content_type.encode('latin1'))]
+
+    async def send(self, send):
+        headers = self.headers
+        if self.status != 304:
+            headers = headers + [(b'content-length', str(len(self.body)).encode('latin1'))]
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class FileResponse(Response):
+    # answers the If-None-Match, Range and If-Range requests as `send_file` in `main.py`
+
+    def __init__(self, request, path, etag, mimetype='application/octet-stream'):
+        Response.__init__(self, content_type=mimetype)
+        self.request = request
+        self.path = path
+        self.etag = etag
+        self.headers += [(b'etag', '"{}"'.format(etag).encode('latin1')),
+                         (b'accept-ranges', b'bytes')]
+
+    async def send(self, send):
+        if _etag_matches(self.request.headers.get('if-none-match', ''), self.etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': self.headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, self.path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            status, start, stop = 200, 0, size
+            headers = list(self.headers)
+            range_header = self.request.headers.get('range')
+            if_range = self.request.headers.get('if-range')
+            if range_header and (if_range is None or _etag_matches(if_range, self.etag)):
+                byte_range = _parse_range(range_header, size)
+                if byte_range is None:
+                    headers.append((b'content-range', 'bytes */{}'.format(size).encode('latin1')))
+                    await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                status, (start, stop) = 206, byte_range
+                headers.append((b'content-range', 'bytes {}-{}/{}'.format(
+                    start, stop - 1, size).encode('latin1')))
+
+            headers.append((b'content-length', str(stop - start).encode('latin1')))
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await loop.run_in_executor(None, f.seek, start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            f.close()
+
+
+def _parse_range(header, size):
+    # returns (start, stop) of a single range `bytes=start-end`, `bytes=start-`
+    # or `bytes=-suffix`, None if it is not satisfiable
+    unit, _, byte_range = header.partition('=')
+    first, _, last = byte_range.strip().partition('-')
+    try:
+        if unit.strip() != 'bytes' or ',' in byte_range:
+            raise ValueError
+        if first:
+            start, stop = int(first), size if not last else min(int(last) + 1, size)
+        else:
+            start, stop = max(size - int(last), 0), size
+    except ValueError:
+        return None
+    if start >= stop:
+        return None
+    return start, stop
+
+
+def _etag_matches(if_none_match, etag):
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+
+def _conditional(request, body, etag):
+    # answers If-None-Match with 304 Not Modified, as `_conditional` in `main.py`
+    if etag is None:
+        return Response(body)
+    if _etag_matches(request.headers.get('if-none-match', ''), etag):
+        response = Response(status=304)
+    else:
+        response = Response(body)
+    response.headers.append((b'etag', '"{}"'.format(etag).encode('latin1')))
+    return response
+
+
+def _json_response(data, status=200):
+    return Response(json.dumps(data, separators=(',', ':')).encode('utf-8'), status)
+
+
+async def _run(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+#######################################
+# Routing
+#######################################
+def route(rule, methods=('GET',)):
+    # the rules have the same syntax as in flask: `<name>` and `<int:name>`
+    def converter(match):
+        pattern = r'\d+' if match.group(1) == 'int' else '[^/]+'
+        return '(?P<{}>{})'.format(match.group(2), pattern)
+
+    pattern = re.compile('^' + re.sub(r'<(?:(\w+):)?(\w+)>', converter, rule) + '$')
+    integers = re.findall(r'<int:(\w+)>', rule)
+
+    def _route(func):
+        ROUTES.append((pattern, rule, integers, methods, func))
+        return func
+
+    return _route
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    response = Response(b'Not Found', 404, 'text/plain')
+    for pattern, rule, integers, methods, func in ROUTES:
+        match = pattern.match(scope['path'])
+        if match is None:
+            continue
+        if not scope['method'] in methods:
+            response = Response(b'Method Not Allowed', 405, 'text/plain')
+            continue
+
+        kwargs = match.groupdict()
+        for key in integers:
+            kwargs[key] = int(kwargs[key])
+        if Global.reloader.is_due():
+            await _run(None, Global.reloader.maybe_reload)
+        try:
+            response = await func(request=Request(scope, receive, rule), **kwargs)
+        except Exception:
+            traceback.print_exc()
+            response = Response(b'Internal Server Error', 500, 'text/plain')
+        break
+
+    if isinstance(response, tuple):
+        response = _json_response(*response)
+    elif isinstance(response, dict):
+        response = _json_response(response)
+    await response.send(send)
+
+
+#######################################
+# Check I/O
+#######################################
+@route('/get_test_input/<username>/<assignment>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignment(Global)
+@wrappers.async_check_rate_limit(Global, 'check_answer')
+async def get_test_input(request, username='', assignment=''):
+    return Response(main._test_input_body(username, assignment))
+
+
+@route('/get_test_inputs/<username>/<assignments>')
+@route('/get_test_inputs/<username>/<md5>/<assignments>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignments(Global)
+@wrappers.async_check_rate_limit(Global, 'check_answer')
+async def get_test_inputs(request, username='', assignments='', md5=None):
+    # the manifest of the local tests is read from the disk
+    return Response(await _run(None, main._test_inputs_body, username, assignments, md5))
+
+
+@route('/check_answer/<username>/<assignment>/<int:ipd>/<answer>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignment(Global)
+@wrappers.async_rate_limit(Global, 'check_answer')
+async def check_answer(request, username='', assignment='', ipd=-1, answer=''):
+    success = await _run(COMPARE_POOL, _check_json_answer, username, assignment, ipd, answer)
+    return {'success': success}
+
+
+def _check_json_answer(username, assignment, ipd, answer):
+    x_answer = np.array(json.loads(answer))
+    return main._check_answer(username, assignment, ipd, x_answer)
+
+
+@route('/check_answer/<username>/<assignment>/<int:ipd>', methods=('POST',))
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignment(Global)
+@wrappers.async_rate_limit(Global, 'check_answer')
+async def check_binary_answer(request, username='', assignment='', ipd=-1):
+    x_answer = main._decode_answer(await request.get_data(),
+                                   request.headers.get('x-dtype', ''),
+                                   request.headers.get('x-shape', ''),
+                                   request.mimetype)
+    success = await _run(COMPARE_POOL, main._check_answer, username, assignment, ipd, x_answer)
+    return {'success': success}
+
+
+@route('/check_answers/<username>', methods=('POST',))
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+async def check_answers(request, username=''):
+    buffer = await request.get_data()
+    return {'success': await _run(COMPARE_POOL, main._check_answers, username, buffer)}
+
+
+#######################################
+# Local test
+#######################################
+@route('/load_tests/<username>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.async_rate_limit(Global, 'load_tests')
+async def load_tests(request, username=''):
+    md5 = await _run(None, Global.md5)
+    if md5 is None:
+        raise wrappers.ServerError('the local tests are only available per assignment.')
+    compression = main._compression(request.args.get('compression'))
+    # the compressed copy is built in the executor on the first request
+    return FileResponse(request, *await _run(None, utils.local_tests_file, compression))
+
+
+@route('/load_tests/<username>/<assignment>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+@wrappers.async_rate_limit(Global, 'load_tests')
+async def load_assignment_tests(request, username='', assignment=''):
+    manifest = await _run(None, Global.local_tests_manifest)
+    if not assignment in manifest:
+        raise wrappers.ServerError("local tests for '{}' are not found.".format(assignment))
+    compression = main._compression(request.args.get('compression'))
+    return FileResponse(request, *await _run(None, utils.local_test_file, assignment, compression))
+
+
+@route('/local_tests_manifest')
+@wrappers.async_measure(Global)
+async def local_tests_manifest(request):
+    etag, body = await _run(None, main._manifest_body)
+    return _conditional(request, body, etag)
+
+
+@route('/check_sum/<md5>')
+@wrappers.async_measure(Global)
+async def check_sum(request, md5):
+    server_md5 = await _run(None, Global.md5)
+    body = json.dumps({'success': md5 == server_md5}).encode('utf-8')
+    # without the bundle of local tests the response never changes
+    return _conditional(request, body, server_md5 or 'no-local-tests')
+
+
+#######################################
+# etc
+#######################################
+@route('/get_progress/<username>')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_username(Global)
+async def get_progress(request, username=''):
+    etag, body = await _run(None, main._progress_body, username)
+    return _conditional(request, body, etag)
+
+
+@route('/progress_stats')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_instructor(Global)
+async def get_progress_stats(request):
+    return await _run(None, main._progress_stats)
+
+
+@route('/progress.csv')
+@wrappers.async_catch_error
+@wrappers.async_measure(Global)
+@wrappers.check_instructor(Global)
+async def get_progress_csv(request):
+    body = await _run(None, main._progress_csv)
+    return Response(body.encode('utf-8'), content_type='text/csv')
+
+
+@route('/metrics')
+async def get_metrics(request):
+    body = await _run(None, Global.metrics.render)
+    return Response(body.encode('utf-8'),
+                    content_type='text/plain; version=0.0.4')
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('The asynchronous server requires uvicorn: pip install uvicorn')
+
+    if main.WORKERS > 1:
+        # the workers import the application by themselves and share the database,
+        # the json files of the progress are written by this process only
+        Global.metrics.reset()
+        Global.progress.start()
+        uvicorn.run('asgi:app', host='0.0.0.0', port=main.PORT, workers=main.WORKERS,
+                    app_dir=utils.CWD)
+    else:
+        uvicorn.run(app, host='0.0.0.0', port=main.PORT)
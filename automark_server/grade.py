@@ -0,0 +1,331 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This script grades the collected submissions offline with the remote tests.
+
+The submissions directory has a `<username>.py` or `<username>.ipynb` file
+or a `<username>/` folder with such files for each user. The code cells of
+the notebooks are executed in order, the cells which fail are skipped.
+`import automark` is replaced with a stub, whose `test_student_function`
+only records the order of the arguments of the function. Otherwise the
+function is called with the inputs as keyword arguments.
+
+Each submission is graded in its own process with a timeout and a memory
+limit, up to `--processes` submissions at once. The remote tests are loaded
+once and shared with the processes. An assignment is completed if the answers
+to all of its test cases are correct, the same check as the server does.
+
+The results are written to the progress of the users in a single batch,
+to `users/shared_state.sqlite3` if `AUTOMARK_WORKERS` > 1 and to
+`users/user_progress/` otherwise. A server running with a single worker keeps
+the progress in memory, so it should be stopped before grading.
+
+Example:
+    python grade.py submissions/ --processes 8 --report report.csv
+"""
+
+from __future__ import print_function
+from multiprocessing import connection
+import multiprocessing
+import traceback
+import argparse
+import types
+import time
+import json
+import csv
+import sys
+import os
+
+import numpy as np
+
+import progress_store
+import shared_state
+import user_registry
+import utils
+
+WORKERS = int(os.environ.get('AUTOMARK_WORKERS', 1))
+EXTENSIONS = ('.py', '.ipynb')
+
+
+##############
+# submissions
+##############
+def find_submissions(submissions_dir):
+    # {username: [filepath, ...]}
+    submissions = {}
+    for name in sorted(os.listdir(submissions_dir)):
+        path = os.path.join(submissions_dir, name)
+        username, extension = os.path.splitext(name)
+        if os.path.isdir(path):
+            filepaths = [os.path.join(path, fname) for fname in sorted(os.listdir(path))
+                         if fname.endswith(EXTENSIONS)]
+            if filepaths:
+                submissions[name] = filepaths
+        elif extension in EXTENSIONS:
+            submissions.setdefault(username, []).append(path)
+    return submissions
+
+
+def _code_cells(filepath):
+    if not filepath.endswith('.ipynb'):
+        with open(filepath) as f:
+            return [f.read()]
+
+    with open(filepath) as f:
+        notebook = json.load(f)
+    cells = []
+    for cell in notebook.get('cells', []):
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source', '')
+        if isinstance(source, list):
+            source = ''.join(source)
+        # the magics and the shell commands are not python
+        lines = [line for line in source.splitlines()
+                 if not line.lstrip().startswith(('%', '!'))]
+        cells.append('\n'.join(lines))
+    return cells
+
+
+def _automark_stub(arg_keys):
+    # the calls of the client only record the order of the arguments
+    def test_student_function(username, function, arg_keys_, *args, **kwargs):
+        arg_keys[function.__name__] = list(arg_keys_)
+
+    def test_student_functions(username, functions, *args, **kwargs):
+        for function, arg_keys_ in functions:
+            arg_keys[function.__name__] = list(arg_keys_)
+
+    module = types.ModuleType('automark')
+    module.test_student_function = test_student_function
+    module.test_student_functions = test_student_functions
+    module.__getattr__ = lambda name: (lambda *args, **kwargs: None)
+    return module
+
+
+def load_submission(filepaths):
+    # returns the namespace of the submission, the order of the arguments and the errors
+    arg_keys = {}
+    sys.modules['automark'] = _automark_stub(arg_keys)
+    namespace = {'__name__': '__main__'}
+    errors = []
+    for filepath in filepaths:
+        for cell in _code_cells(filepath):
+            try:
+                exec(compile(cell, filepath, 'exec'), namespace)
+            except BaseException:
+                errors.append(traceback.format_exc(limit=0).strip())
+    return namespace, arg_keys, errors
+
+
+##############
+# grading
+##############
+def _case_input(data, idx):
+    # a copy, so the submission can not change the memory-mapped tests
+    input_ = data['inputs'][idx]
+    if data['inputs_are_packed']:
+        return {key: np.array(value['data']) if value['type'] == 'ndarray' else value['data']
+                for key, value in input_.items()}
+    return {key: np.array(value) if isinstance(value, np.ndarray) else value
+            for key, value in input_.items()}
+
+
+def grade_function(function, data, arg_keys=None):
+    # returns the number of correct answers and the first error
+    n_correct, error = 0, None
+    for idx in range(len(data['ipd'])):
+        input_ = _case_input(data, idx)
+        try:
+            if arg_keys is None:
+                answer = function(**input_)
+            else:
+                answer = function(*[input_[key] for key in arg_keys])
+        except Exception:
+            error = error or traceback.format_exc(limit=0).strip()
+            continue
+        if utils.is_correct(data['outputs'][idx], answer, data.get('comparator')):
+            n_correct += 1
+    return n_correct, error
+
+
+def _grade_submission(conn, filepaths, data_dict, memory_limit):
+    try:
+        if memory_limit:
+            import resource
+            limit = memory_limit * 1024 ** 2
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        # the output of the submissions is discarded
+        devnull = open(os.devnull, 'w')
+        sys.stdout = sys.stderr = devnull
+
+        namespace, arg_keys, errors = load_submission(filepaths)
+        if errors:
+            conn.send(('error', errors[0]))
+        for assignment in sorted(data_dict):
+            function = namespace.get(assignment)
+            if not callable(function):
+                continue
+            n_correct, error = grade_function(function, data_dict[assignment],
+                                              arg_keys.get(assignment))
+            conn.send(('result', assignment, n_correct, error))
+    except MemoryError:
+        conn.send(('error', 'MemoryError: the memory limit is exceeded'))
+    finally:
+        conn.close()
+
+
+def _get_context():
+    # the forked processes share the loaded tests without copying them
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def grade(submissions, data_dict, processes=None, timeout=600.0, memory_limit=4096):
+    # yields (username, {assignment: (n_correct, n_cases, error)}, error) as they finish
+    context = _get_context()
+    processes = processes or os.cpu_count() or 1
+    pending = list(submissions.items())[::-1]
+    running = {}
+
+    def finish(conn, error=None):
+        username, process, _, results, errors = running.pop(conn)
+        conn.close()
+        process.join(1.0)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        if error is None and process.exitcode:
+            error = 'the process exited with the code {}'.format(process.exitcode)
+        if error is not None:
+            errors.append(error)
+        return username, results, errors[0] if errors else None
+
+    while pending or running:
+        while pending and len(running) < processes:
+            username, filepaths = pending.pop()
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            process = context.Process(target=_grade_submission,
+                                      args=(child_conn, filepaths, data_dict, memory_limit))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            running[parent_conn] = (username, process, time.time() + timeout, {}, [])
+
+        now = time.time()
+        deadline = min(entry[2] for entry in running.values())
+        for conn in connection.wait(list(running), timeout=max(deadline - now, 0.0)):
+            try:
+                message = conn.recv()
+            except EOFError:
+                yield finish(conn)
+                continue
+            username, _, _, results, errors = running[conn]
+            if message[0] == 'result':
+                _, assignment, n_correct, error = message
+                results[assignment] = (n_correct, len(data_dict[assignment]['ipd']), error)
+            else:
+                errors.append(message[1])
+
+        now = time.time()
+        for conn in [conn for conn, entry in running.items() if entry[2] <= now]:
+            running[conn][1].kill()
+            yield finish(conn, 'the time limit of {:.0f}s is exceeded'.format(timeout))
+
+
+##############
+# main
+##############
+def _progress_store():
+    if WORKERS > 1:
+        return shared_state.SharedProgressStore(shared_state.Database(utils.SHARED_STATE_PATH))
+    return progress_store.ProgressStore()
+
+
+def _write_report(filepath, rows):
+    with open(filepath, 'w') as f:
+        if filepath.endswith('.json'):
+            json.dump(rows, f, indent=1)
+            return
+        writer = csv.DictWriter(f, ['username', 'assignment', 'correct', 'cases',
+                                    'completed', 'error'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grade the collected submissions offline')
+    parser.add_argument('submissions', help='the directory with the submissions')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='the number of submissions graded at once, the number of cores by default')
+    parser.add_argument('--timeout', type=float, default=600.0,
+                        help='the time limit of each submission in seconds')
+    parser.add_argument('--memory-limit', type=int, default=4096,
+                        help='the memory limit of each submission in MiB, 0 disables it')
+    parser.add_argument('--report', help='save the results to this csv or json file')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='do not write the results to the progress of the users')
+    args = parser.parse_args()
+
+    start = time.time()
+    data_dict = utils.get_data_dict()
+    users = user_registry.UserRegistry()
+    submissions = find_submissions(args.submissions)
+    print('Loaded {} assignments and {} submissions in {:.2f}s'.format(
+        len(data_dict), len(submissions), time.time() - start))
+
+    start = time.time()
+    rows, attempts, n_cases = [], [], 0
+    for username, results, error in grade(submissions, data_dict, args.processes,
+                                          args.timeout, args.memory_limit):
+        registered = username in users
+        line = ', '.join('{} {}/{}'.format(assignment, n_correct, n)
+                         for assignment, (n_correct, n, _) in sorted(results.items()))
+        print('{}: {}{}{}'.format(username, line or 'no assignments',
+                                  '' if registered else ' (unknown user)',
+                                  '\n    ' + error if error else ''))
+        if not results:
+            rows.append({'username': username, 'error': error})
+        for assignment, (n_correct, n, assignment_error) in sorted(results.items()):
+            completed = n_correct == n
+            n_cases += n
+            rows.append({'username': username, 'assignment': assignment,
+                         'correct': n_correct, 'cases': n, 'completed': completed,
+                         'error': assignment_error or error})
+            if registered:
+                attempts.append((username, assignment, completed))
+    elapsed = time.time() - start
+    print('Graded {} submissions and {} test cases in {:.2f}s: '
+          '{:.2f} submissions/s, {:.0f} test cases/s'.format(
+              len(submissions), n_cases, elapsed,
+              len(submissions) / max(elapsed, 1e-9), n_cases / max(elapsed, 1e-9)))
+
+    if args.report:
+        _write_report(args.report, rows)
+    if not args.dry_run and attempts:
+        progress = _progress_store()
+        progress.record_attempts(attempts)
+        progress.flush()
+        print('Recorded {} attempts'.format(len(attempts)))
+
+
+if __name__ == '__main__':
+    main()
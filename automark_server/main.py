@@ -26,78 +26,286 @@ This scipt runs the server application of AutoMark.
 /check_answer/<username>/<assignment>/<int:ipd>/<answer>
     Returns `True` if the answer is correct, otherwise returns `False`.
 
+/check_answer/<username>/<assignment>/<int:ipd> [POST]
+    Same as above. The answer is sent in the body as a raw little-endian buffer.
+    Its dtype and shape are passed in the `X-Dtype` and `X-Shape` headers.
+    The answers which are not numeric arrays, e.g. tuples and dicts, are sent
+    as json with the `application/json` content type.
+
+/get_test_inputs/<username>/<assignments>
+/get_test_inputs/<username>/<md5>/<assignments>
+    Returns the input data and the md5 of the local tests for each of the
+    comma-separated assignments. If `md5` is given, also returns whether
+    the local tests with this md5 are up-to-date.
+
+/check_answers/<username> [POST]
+    Checks the answers for several assignments at once.
+    The body is a uint32 header length, a json header
+    `[{"assignment": .., "ipd": .., "dtype": .., "shape": [..]}, ...]`
+    and the raw little-endian answers. The answers which are not numeric
+    arrays are in the header as `{"assignment": .., "ipd": .., "json": ..}`.
+    Returns `{"success": {assignment: bool}}`.
+
 /load_tests/<username>
-    Sends the local tests.
+    Sends the local tests. The md5 of the tests is used as the ETag.
+    With `?compression=gzip` sends their gzip-compressed copy, which is built
+    once per version. Both support Range and If-Range requests.
+
+/load_tests/<username>/<assignment>
+    Sends the local tests of the assignment, same as above.
+
+/local_tests_manifest
+    Returns the md5 of the local tests and the md5 of the local tests of each assignment.
+    The md5 of the response is used as the ETag.
 
 /check_sum/<md5>
     Returns the md5 sum of the up-to-date local tests.
+    The md5 of the up-to-date local tests is used as the ETag.
 
 /get_progress/<username>
     Returns a json with the current progress of the user.
+    The md5 of the response is used as the ETag. The response is rendered
+    once per version of the progress of the user, of the user info and of
+    the assignments. The routes with an ETag answer `If-None-Match` with 304 Not Modified.
+
+/progress_stats
+    Returns the number of users and, for each assignment, the number and
+    the percentage of users who attempted and completed it.
+
+/progress.csv
+    Returns the state of each assignment for each user as a csv file.
+    The instructor routes require `AUTOMARK_INSTRUCTOR_TOKEN` to be set and
+    the same token in the `X-Instructor-Token` header or the `token` parameter.
+
+/metrics
+    Returns the number of requests, errors and the latency histogram of each route
+    in the Prometheus text format.
+
+The application listens on the port `AUTOMARK_PORT` (1234 by default).
+Set `AUTOMARK_WORKERS=N` to serve the application with N worker processes.
+New users and assignments are picked up without restarting the server.
+The workers share the rate limits and the progress of the users through
+`users/shared_state.sqlite3`.
 """
 
-from flask import Flask, jsonify, render_template
-from werkzeug.serving import run_simple
+from flask import Flask, jsonify, render_template, request
+from werkzeug.serving import make_server, run_simple
 from random import randrange
 import numpy as np
+import hashlib
+import signal
 import json
-
+import csv
+import io
+import sys
+import os
+
+import metrics
+import progress_store
+import rate_limit
+import reloader
+import shared_state
+import user_registry
 import utils
 import wrappers
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 
+WORKERS = int(os.environ.get('AUTOMARK_WORKERS', 1))
+PORT = int(os.environ.get('AUTOMARK_PORT', 1234))
+# the number of requests per period in seconds allowed to each user.
+# the limits of an assignment are set with the (endpoint, assignment) key, e.g.
+# ('check_answer', 'matmul'): (1, 60)
+RATE_LIMITS = {
+    'check_answer': (1, 30),
+    'load_tests': (20, 600),
+}
+# the token of the instructor routes, they are disabled if it is not set
+INSTRUCTOR_TOKEN = os.environ.get('AUTOMARK_INSTRUCTOR_TOKEN')
+
 
 class Global:
-    users = utils.get_users_list()
-    progress = utils.get_users_progress()
-    timeout = {}
-    data_dict = utils.get_data_dict()
+    # `users`, `data_dict` and `assignments` are kept up-to-date by `reloader`
+    users = user_registry.UserRegistry()
+    # {username: (user, assignments, progress version, etag, body)}
+    progress_cache = {}
+    instructor_token = INSTRUCTOR_TOKEN
+    if WORKERS > 1:
+        database = shared_state.Database(utils.SHARED_STATE_PATH)
+        # the json files are written by a single process, see `run_workers`
+        progress = shared_state.SharedProgressStore(database, flush_interval=1.0)
+        rate_limit = shared_state.SharedRateLimiter(database, RATE_LIMITS)
+        metrics = shared_state.SharedMetrics(database)
+    else:
+        progress = progress_store.ProgressStore(flush_interval=1.0).start()
+        rate_limit = rate_limit.RateLimiter(RATE_LIMITS)
+        metrics = metrics.Metrics()
 
     def md5():
         return utils.get_md5()
 
+    def local_tests_manifest():
+        return utils.get_local_tests_manifest()
+
+
+Global.reloader = reloader.Reloader(Global, interval=5.0)
+
+
+@app.before_request
+def reload_assignments_and_users():
+    Global.reloader.maybe_reload()
+
 
 #######################################
 # Check I/O
 #######################################
 @app.route('/get_test_input/<username>/<assignment>', methods=['GET'])
 @wrappers.catch_error
+@wrappers.measure(Global)
 @wrappers.check_username(Global)
-@wrappers.check_timeout(Global)
 @wrappers.check_assignment(Global)
+@wrappers.check_rate_limit(Global, 'check_answer')
 def get_test_input(username='', assignment=''):
-    random_ipd = randrange(len(Global.data_dict[assignment]["ipd"]))
-    dict_ = {
-        "username": username,
-        "ipd": int(Global.data_dict[assignment]["ipd"][random_ipd]),
-        "input": Global.data_dict[assignment]['inputs'][random_ipd]
-    }
-    return jsonify(dict_)
+    body = _test_input_body(username, assignment)
+    return app.response_class(body, mimetype='application/json')
+
+
+@app.route('/get_test_inputs/<username>/<assignments>', methods=['GET'])
+@app.route('/get_test_inputs/<username>/<md5>/<assignments>', methods=['GET'])
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignments(Global)
+@wrappers.check_rate_limit(Global, 'check_answer')
+def get_test_inputs(username='', assignments='', md5=None):
+    body = _test_inputs_body(username, assignments, md5)
+    return app.response_class(body, mimetype='application/json')
+
+
+# the bodies of the responses are shared with the asynchronous server in `asgi.py`
+# each request uses a single version of `data_dict`, which may be swapped by `reloader`
+def _test_input_body(username, assignment):
+    return b''.join([
+        b'{"username": ', json.dumps(username).encode('utf-8'),
+        b', ', _random_input_json(Global.data_dict, assignment), b'}'
+    ])
+
+
+def _test_inputs_body(username, assignments, md5=None):
+    data_dict = Global.data_dict
+    manifest = Global.local_tests_manifest()
+    inputs = []
+    for assignment in assignments.split(','):
+        inputs.append(b''.join([
+            json.dumps(assignment).encode('utf-8'), b': {',
+            _random_input_json(data_dict, assignment), b'}'
+        ]))
+    local_tests = {assignment: manifest.get(assignment) for assignment in assignments.split(',')}
+
+    body = [b'{"username": ', json.dumps(username).encode('utf-8')]
+    if md5 is not None:
+        body += [b', "tests_are_valid": ', json.dumps(md5 == Global.md5()).encode('utf-8')]
+    body += [
+        b', "local_tests": ', json.dumps(local_tests).encode('utf-8'),
+        b', "inputs": {', b', '.join(inputs), b'}}'
+    ]
+    return b''.join(body)
+
+
+def _random_input_json(data_dict, assignment):
+    data = _get_assignment(data_dict, assignment)
+    return utils.get_input_json(data, randrange(len(data["ipd"])))
 
 
 @app.route('/check_answer/<username>/<assignment>/<int:ipd>/<answer>', methods=['GET'])
 @wrappers.catch_error
+@wrappers.measure(Global)
 @wrappers.check_username(Global)
-@wrappers.check_timeout(Global)
 @wrappers.check_assignment(Global)
-@wrappers.add_timeout(Global, 30)
+@wrappers.rate_limit(Global, 'check_answer')
 def check_answer(username='', assignment='', ipd=-1, answer=''):
-    if not assignment in Global.progress[username]:
-        Global.progress[username][assignment] = False
-        utils.update_progress(username, Global.progress[username])
-
-    ipd_idx = Global.data_dict[assignment]['ipd'].index(ipd)
     x_answer = np.array(json.loads(answer))
-    x_true = Global.data_dict[assignment]['outputs'][ipd_idx]
+    return jsonify({'success': _check_answer(username, assignment, ipd, x_answer)})
+
+
+@app.route('/check_answer/<username>/<assignment>/<int:ipd>', methods=['POST'])
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_username(Global)
+@wrappers.check_assignment(Global)
+@wrappers.rate_limit(Global, 'check_answer')
+def check_binary_answer(username='', assignment='', ipd=-1):
+    x_answer = _decode_answer(request.get_data(),
+                              request.headers.get('X-Dtype', ''),
+                              request.headers.get('X-Shape', ''),
+                              request.mimetype)
+    return jsonify({'success': _check_answer(username, assignment, ipd, x_answer)})
+
+
+@app.route('/check_answers/<username>', methods=['POST'])
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_username(Global)
+def check_answers(username=''):
+    return jsonify({'success': _check_answers(username, request.get_data())})
+
+
+def _decode_answer(buffer, dtype, shape, mimetype=None):
+    # the answers which are not numeric arrays are sent as json
+    try:
+        if mimetype == 'application/json':
+            return json.loads(buffer.decode('utf-8'))
+        return utils.decode_array(buffer, dtype, shape)
+    except (TypeError, ValueError):
+        raise wrappers.ServerError('the answer could not be decoded.')
 
-    answer_is_correct = np.allclose(x_true, x_answer, atol=1e-5)
-    if not Global.progress[username][assignment] and answer_is_correct:
-        Global.progress[username][assignment] = answer_is_correct
-        utils.update_progress(username, Global.progress[username])
 
-    return jsonify({'success': answer_is_correct})
+def _check_answers(username, buffer):
+    try:
+        answers = utils.decode_answers(buffer)
+    except (TypeError, ValueError, KeyError):
+        raise wrappers.ServerError('the answers could not be decoded.')
+
+    data_dict = Global.data_dict
+    ground_truths = [_get_ground_truth(data_dict, assignment, ipd)
+                     for assignment, ipd, _ in answers]
+    wrappers.acquire_rate_limit(Global, username, 'check_answer',
+                                [assignment for assignment, _, _ in answers])
+
+    success = {}
+    for (assignment, _, x_answer), (x_true, comparator) in zip(answers, ground_truths):
+        success[assignment] = _is_correct_answer(username, assignment, x_true, x_answer,
+                                                 comparator)
+    return success
+
+
+def _check_answer(username, assignment, ipd, x_answer):
+    x_true, comparator = _get_ground_truth(Global.data_dict, assignment, ipd)
+    return _is_correct_answer(username, assignment, x_true, x_answer, comparator)
+
+
+def _get_assignment(data_dict, assignment):
+    # the assignment may be removed by a reload after `check_assignment`
+    data = data_dict.get(assignment)
+    if data is None:
+        raise wrappers.ServerError("assignment '{}' is not found.".format(assignment))
+    return data
+
+
+def _get_ground_truth(data_dict, assignment, ipd):
+    data = _get_assignment(data_dict, assignment)
+    ipd_idx = data['ipd_index'].get(ipd)
+    if ipd_idx is None:
+        raise wrappers.ServerError("test case '{}' is not found.".format(ipd))
+    # the comparator of the assignment is set in its test data
+    return data['outputs'][ipd_idx], data.get('comparator')
+
+
+def _is_correct_answer(username, assignment, x_true, x_answer, comparator=None):
+    answer_is_correct = utils.is_correct(x_true, x_answer, comparator)
+    Global.progress.record_attempt(username, assignment, answer_is_correct)
+    return answer_is_correct
 
 
 #######################################
@@ -105,15 +313,53 @@ def check_answer(username='', assignment='', ipd=-1, answer=''):
 #######################################
 @app.route('/load_tests/<username>')
 @wrappers.catch_error
+@wrappers.measure(Global)
 @wrappers.check_username(Global)
-@wrappers.check_timeout(Global)
+@wrappers.rate_limit(Global, 'load_tests')
 def load_tests(username=''):
-    return utils.send_local_tests()
+    if Global.md5() is None:
+        raise wrappers.ServerError('the local tests are only available per assignment.')
+    return utils.send_local_tests(_compression(request.args.get('compression')))
+
+
+@app.route('/load_tests/<username>/<assignment>')
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_username(Global)
+@wrappers.rate_limit(Global, 'load_tests')
+def load_assignment_tests(username='', assignment=''):
+    if not assignment in Global.local_tests_manifest():
+        raise wrappers.ServerError("local tests for '{}' are not found.".format(assignment))
+    return utils.send_local_test(assignment, _compression(request.args.get('compression')))
+
+
+def _compression(compression):
+    if compression is not None and not compression in utils.COMPRESSIONS:
+        raise wrappers.ServerError("compression '{}' is not supported.".format(compression))
+    return compression
+
+
+@app.route('/local_tests_manifest')
+@wrappers.measure(Global)
+def local_tests_manifest():
+    etag, body = _manifest_body()
+    return _conditional(app.response_class(body, mimetype='application/json'), etag)
+
+
+def _manifest_body():
+    # returns the etag and the body of the manifest, the clients poll it
+    manifest = {'md5': Global.md5(), 'assignments': Global.local_tests_manifest()}
+    body = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    return hashlib.md5(body).hexdigest(), body
 
 
 @app.route('/check_sum/<md5>')
+@wrappers.measure(Global)
 def check_sum(md5):
-    return jsonify({'success': md5 == Global.md5()})
+    server_md5 = Global.md5()
+    response = jsonify({'success': md5 == server_md5})
+    # without the bundle of local tests the response never changes
+    return _conditional(response, server_md5 or 'no-local-tests')
 
 
 #######################################
@@ -121,30 +367,145 @@ def check_sum(md5):
 #######################################
 @app.route('/get_progress/<username>')
 @wrappers.catch_error
+@wrappers.measure(Global)
 @wrappers.check_username(Global)
 def get_progress(username=''):
+    etag, body = _progress_body(username)
+    return _conditional(app.response_class(body, mimetype='application/json'), etag)
+
+
+def _conditional(response, etag):
+    # answers If-None-Match with 304 Not Modified
+    if etag is not None:
+        response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _progress_body(username):
+    # returns the etag and the body of the progress of the user
+    user = Global.users.get(username)
+    if user is None:
+        raise wrappers.ServerError("user '{}' is not registered.".format(username))
+    # the version is read first, so a concurrent change renders the progress again
+    assignments = Global.assignments
+    version = Global.progress.version(username)
+    cached = Global.progress_cache.get(username)
+    if (cached is None or cached[0] is not user or cached[1] is not assignments or
+            cached[2] != version):
+        body = json.dumps(_progress(username, user, assignments), sort_keys=True)
+        body = body.encode('utf-8')
+        cached = (user, assignments, version, hashlib.md5(body).hexdigest(), body)
+        Global.progress_cache[username] = cached
+    return cached[3], cached[4]
+
+
+def _progress(username, user, assignments):
     fancy_progress = {}
-    user_progress = Global.progress[username]
+    user_progress = Global.progress.get(username)
 
-    for func_desc in Global.data_dict.keys():
+    for func_desc in assignments:
         if func_desc in user_progress:
             fancy_progress[func_desc] = 'completed' if user_progress[func_desc] else 'attempted'
         else:
             fancy_progress[func_desc] = 'not attempted'
 
-    user_data = utils.get_user_info(username)
     data = {
-        'name': user_data['name'],
-        'mail': user_data['mail'],
+        'name': user.name,
+        'mail': user.mail,
         'progress': fancy_progress
     }
-    return jsonify(data)
+    return data
+
+
+@app.route('/progress_stats')
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_instructor(Global)
+def get_progress_stats():
+    return jsonify(_progress_stats())
+
+
+@app.route('/progress.csv')
+@wrappers.catch_error
+@wrappers.measure(Global)
+@wrappers.check_instructor(Global)
+def get_progress_csv():
+    return app.response_class(_progress_csv(), mimetype='text/csv')
+
+
+def _progress_stats():
+    assignments = sorted(Global.data_dict)
+    n_users = len(Global.users)
+    attempted, completed = Global.progress.counts(assignments)
+    attempted_percent = np.round(100.0 * attempted / max(n_users, 1), 2)
+    completed_percent = np.round(100.0 * completed / max(n_users, 1), 2)
+
+    stats = {}
+    for idx, assignment in enumerate(assignments):
+        stats[assignment] = {
+            'attempted': int(attempted[idx]),
+            'completed': int(completed[idx]),
+            'attempted_percent': float(attempted_percent[idx]),
+            'completed_percent': float(completed_percent[idx]),
+        }
+    return {'users': n_users, 'assignments': stats}
+
+
+def _progress_csv():
+    # a row per user with the state of each assignment
+    usernames = sorted(Global.users)
+    assignments = sorted(Global.data_dict)
+    states = Global.progress.states(usernames, assignments)
+    labels = np.array(['not attempted', 'attempted', 'completed'])[states]
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['username', 'name', 'mail'] + assignments)
+    for username, row in zip(usernames, labels):
+        user = Global.users.get(username)
+        if user is not None:
+            writer.writerow([username, user.name, user.mail] + row.tolist())
+    return output.getvalue()
+
+
+@app.route('/metrics')
+def get_metrics():
+    return app.response_class(Global.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def run_workers(host, port, workers):
+    # the workers are forked after the server socket is bound and share it
+    server = make_server(host, port, app, threaded=True)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    # the threads do not survive a fork, so the parent flushes the progress
+    Global.progress.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
 
 
 if __name__ == '__main__':
-    run_simple('0.0.0.0',
-               port=1234,
-               application=app,
-               use_reloader=True,
-               reloader_interval=60 * 10,
-               threaded=True)
+    if WORKERS > 1:
+        Global.metrics.reset()
+        run_workers('0.0.0.0', port=PORT, workers=WORKERS)
+    else:
+        run_simple('0.0.0.0',
+                   port=PORT,
+                   application=app,
+                   threaded=True)
@@ -0,0 +1,124 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+Request metrics of the server: the number of requests, the number of errors
+and the latency histogram of each route.
+They are exposed in the Prometheus text format on `/metrics`.
+"""
+
+import bisect
+import threading
+
+
+# the upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ERRORS = ('rejected', 'exception')
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {thread ident: {route: stats}}, each thread only updates its own counters,
+        # so a request does not take a lock. The idents of finished threads are reused
+        self._threads = {}
+
+    def observe(self, route, duration, error=None):
+        # `error` is one of `ERRORS` or None
+        bucket = bisect.bisect_left(BUCKETS, duration)
+        routes = self._threads.get(threading.get_ident())
+        if routes is None:
+            with self._lock:
+                routes = self._threads[threading.get_ident()] = {}
+        stats = routes.get(route)
+        if stats is None:
+            stats = routes[route] = _empty_stats()
+        stats['count'] += 1
+        stats['sum'] += duration
+        stats['buckets'][bucket] += 1
+        if error is not None:
+            stats['errors'][error] += 1
+
+    def snapshot(self):
+        # the counters of the threads are merged, the dicts are copied as the threads
+        # may add routes at the same time
+        with self._lock:
+            threads = list(self._threads.values())
+        return merge(dict(list(routes.items())) for routes in threads)
+
+    def render(self):
+        return render(self.snapshot())
+
+
+def _empty_stats():
+    return {
+        'count': 0,
+        'sum': 0.0,
+        'buckets': [0] * (len(BUCKETS) + 1),
+        'errors': {error: 0 for error in ERRORS},
+    }
+
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for route, stats in snapshot.items():
+            total = merged.setdefault(route, _empty_stats())
+            total['count'] += stats['count']
+            total['sum'] += stats['sum']
+            for bucket, count in enumerate(stats['buckets']):
+                total['buckets'][bucket] += count
+            for error in ERRORS:
+                total['errors'][error] += stats['errors'].get(error, 0)
+    return merged
+
+
+def render(snapshot):
+    lines = [
+        '# HELP automark_requests_total The number of requests.',
+        '# TYPE automark_requests_total counter',
+    ]
+    for route, stats in sorted(snapshot.items()):
+        lines.append('automark_requests_total{{route="{}"}} {}'.format(route, stats['count']))
+
+    lines += [
+        '# HELP automark_request_errors_total The number of requests which ended with an error.',
+        '# TYPE automark_request_errors_total counter',
+    ]
+    for route, stats in sorted(snapshot.items()):
+        for error in ERRORS:
+            lines.append('automark_request_errors_total{{route="{}",kind="{}"}} {}'.format(
+                route, error, stats['errors'][error]))
+
+    lines += [
+        '# HELP automark_request_duration_seconds The latency of requests.',
+        '# TYPE automark_request_duration_seconds histogram',
+    ]
+    for route, stats in sorted(snapshot.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), stats['buckets']):
+            cumulative += count
+            lines.append('automark_request_duration_seconds_bucket{{route="{}",le="{}"}} {}'.format(
+                route, bound, cumulative))
+        lines.append('automark_request_duration_seconds_sum{{route="{}"}} {}'.format(
+            route, stats['sum']))
+        lines.append('automark_request_duration_seconds_count{{route="{}"}} {}'.format(
+            route, stats['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,174 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+The progress of the users is kept in memory and is written to
+`users/user_progress/<username>.json` by a background thread.
+The files are written atomically, so a crash never leaves a truncated file.
+
+The progress is a matrix of users x assignments of int8 states:
+NOT_ATTEMPTED, ATTEMPTED or COMPLETED. The rows and the columns are found
+with the index maps, new users and assignments are appended and the matrix
+grows by doubling. The course-wide statistics are reductions of its columns.
+
+Each user also has a version, which is incremented whenever the progress of
+the user changes, so the rendered progress can be cached until then.
+"""
+
+import atexit
+import threading
+
+import numpy as np
+
+import utils
+
+NOT_ATTEMPTED, ATTEMPTED, COMPLETED = 0, 1, 2
+
+
+class ProgressStore:
+
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self._user_index = {}
+        self._assignment_index = {}
+        self._assignments = []
+        self._states = np.zeros((0, 0), dtype=np.int8)
+        self._versions = np.zeros(0, dtype=np.int64)
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        for username, user_progress in utils.get_users_progress().items():
+            row = self._row(username)
+            for assignment, completed in user_progress.items():
+                self._states[row, self._column(assignment)] = COMPLETED if completed else ATTEMPTED
+
+    def _row(self, username):
+        if not username in self._user_index:
+            self._user_index[username] = len(self._user_index)
+            self._grow()
+        return self._user_index[username]
+
+    def _column(self, assignment):
+        if not assignment in self._assignment_index:
+            self._assignment_index[assignment] = len(self._assignments)
+            self._assignments.append(assignment)
+            self._grow()
+        return self._assignment_index[assignment]
+
+    def _grow(self):
+        n_rows, n_columns = self._states.shape
+        if len(self._user_index) > n_rows or len(self._assignments) > n_columns:
+            states = np.zeros((max(len(self._user_index), 2 * n_rows, 16),
+                               max(len(self._assignments), 2 * n_columns, 4)), dtype=np.int8)
+            states[:n_rows, :n_columns] = self._states
+            versions = np.zeros(states.shape[0], dtype=np.int64)
+            versions[:n_rows] = self._versions
+            self._states, self._versions = states, versions
+
+    def get(self, username):
+        # returns a copy of the user's progress: {assignment: completed}
+        with self._lock:
+            return self._user_progress(username)
+
+    def _user_progress(self, username):
+        row = self._user_index.get(username)
+        if row is None:
+            return {}
+        states = self._states[row, :len(self._assignments)]
+        return {self._assignments[column]: bool(states[column] == COMPLETED)
+                for column in np.flatnonzero(states)}
+
+    def version(self, username):
+        # changes whenever the progress of the user changes
+        with self._lock:
+            row = self._user_index.get(username)
+            return 0 if row is None else int(self._versions[row])
+
+    def record_attempt(self, username, assignment, success):
+        self.record_attempts([(username, assignment, success)])
+
+    def record_attempts(self, attempts):
+        # an assignment is completed once any of the attempts succeeds
+        with self._lock:
+            for username, assignment, success in attempts:
+                state = COMPLETED if success else ATTEMPTED
+                row, column = self._row(username), self._column(assignment)
+                if self._states[row, column] < state:
+                    self._states[row, column] = state
+                    self._versions[row] += 1
+                    self._dirty.add(username)
+
+    def counts(self, assignments):
+        # returns the number of users who attempted and who completed each assignment
+        with self._lock:
+            columns = [self._assignment_index.get(assignment) for assignment in assignments]
+            states = self._states[:len(self._user_index)]
+            attempted = np.count_nonzero(states, axis=0)
+            completed = np.count_nonzero(states == COMPLETED, axis=0)
+        return (np.array([0 if c is None else attempted[c] for c in columns], dtype=np.int64),
+                np.array([0 if c is None else completed[c] for c in columns], dtype=np.int64))
+
+    def states(self, usernames, assignments):
+        # returns the int8 matrix of the states of the users x assignments
+        with self._lock:
+            rows = np.array([self._user_index.get(u, -1) for u in usernames], dtype=np.int64)
+            columns = np.array([self._assignment_index.get(a, -1) for a in assignments],
+                               dtype=np.int64)
+            states = self._states[np.ix_(np.maximum(rows, 0), np.maximum(columns, 0))]
+        states[rows < 0] = NOT_ATTEMPTED
+        states[:, columns < 0] = NOT_ATTEMPTED
+        return states
+
+    def flush(self):
+        with self._flush_lock:
+            for username, user_progress in self._take_dirty().items():
+                try:
+                    utils.update_progress(username, user_progress)
+                except EnvironmentError:
+                    # retry during the next flush
+                    self._mark_dirty(username)
+
+    def _take_dirty(self):
+        # returns the progress of the dirty users and marks them as clean
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return {username: self._user_progress(username) for username in dirty}
+
+    def _mark_dirty(self, username):
+        with self._lock:
+            self._dirty.add(username)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
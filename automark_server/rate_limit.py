@@ -0,0 +1,105 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+The rate limits of the users.
+
+Each limit is a number of requests per period, e.g. `(1, 30)`, and is
+enforced per user with the generic cell rate algorithm: a token bucket of
+`requests` tokens, refilled at `requests / period` tokens per second, which
+only stores the time when the bucket is full again. A check is O(1).
+The full buckets are removed by a sweep at most once per `sweep_interval`,
+so the table only holds the users active during the last period.
+
+The limits are a dict:
+    {endpoint: (requests, period), (endpoint, assignment): (requests, period)}
+The limits of `(endpoint, assignment)` override the limits of `endpoint`
+and are counted separately for this assignment.
+"""
+
+import contextlib
+import threading
+import time
+
+
+class RateLimiter:
+
+    def __init__(self, limits, sweep_interval=60.0):
+        self.limits = limits
+        self.sweep_interval = sweep_interval
+        self._full_at = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def check(self, username, endpoint, assignments=(None,)):
+        # returns the seconds until the request is allowed, the request is not counted
+        return self._acquire(username, endpoint, assignments, consume=False)
+
+    def acquire(self, username, endpoint, assignments=(None,)):
+        # returns the seconds until the request is allowed, the request is counted if it is 0
+        return self._acquire(username, endpoint, assignments, consume=True)
+
+    def _buckets(self, username, endpoint, assignments):
+        buckets = {}
+        for assignment in assignments:
+            if (endpoint, assignment) in self.limits:
+                buckets[(username, endpoint, assignment)] = self.limits[(endpoint, assignment)]
+            elif endpoint in self.limits:
+                buckets[(username, endpoint, None)] = self.limits[endpoint]
+        return buckets
+
+    def _acquire(self, username, endpoint, assignments, consume):
+        buckets = self._buckets(username, endpoint, assignments)
+        if not buckets:
+            return 0.0
+
+        with self._transaction():
+            now = time.time()
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                self._sweep(now)
+
+            full_at = self._load(list(buckets))
+            wait = 0.0
+            updates = {}
+            for key, (requests, period) in buckets.items():
+                interval = float(period) / requests
+                updates[key] = max(full_at.get(key, now), now) + interval
+                wait = max(wait, updates[key] - period - now)
+            if consume and wait <= 0.0:
+                self._store(updates)
+        return wait
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            yield
+
+    def _load(self, keys):
+        return {key: self._full_at[key] for key in keys if key in self._full_at}
+
+    def _store(self, full_at):
+        self._full_at.update(full_at)
+
+    def _sweep(self, now):
+        for key in [key for key, full_at in self._full_at.items() if full_at <= now]:
+            del self._full_at[key]
+
+    def __len__(self):
+        return len(self._full_at)
@@ -0,0 +1,121 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+The users and the remote tests are reloaded without restarting the server.
+The users are updated by `user_registry.UserRegistry`.
+
+The folders are scanned at most once per `interval` by the request which
+comes first after it. Only the files whose inode, size or mtime changed are
+loaded again. The new `users` list and `data_dict` are then swapped in at
+once, so a request which already got a version of an assignment keeps
+using it. The files should be replaced atomically (written to a temporary
+file and renamed), as the remote tests are memory-mapped.
+The legacy `remote_tests.pickle` is reloaded as a whole.
+`assignments` is the sorted tuple of the assignments of the current `data_dict`,
+a new tuple is set with every new version.
+"""
+
+import os
+import threading
+import time
+
+import utils
+
+
+def _identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class Reloader:
+
+    def __init__(self, storage, interval=5.0):
+        self.storage = storage
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._scanned_at = (None, 0.0)
+        self._tests_identity = {}
+        self._set_data_dict({})
+        self.reload()
+
+    def is_due(self):
+        # the forked workers scan the folders by themselves
+        pid, scanned_at = self._scanned_at
+        return pid != os.getpid() or time.time() - scanned_at >= self.interval
+
+    def maybe_reload(self):
+        if not self.is_due():
+            return
+        # the other requests do not wait for the scan
+        if self._lock.acquire(False):
+            try:
+                self._reload()
+            finally:
+                self._lock.release()
+
+    def reload(self):
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        self._scanned_at = (os.getpid(), time.time())
+        self.storage.users.update()
+        self._reload_remote_tests()
+
+    def _reload_remote_tests(self):
+        identity = _identity(utils.REMOTE_TESTS_PATH)
+        if identity is not None:
+            if self._tests_identity != {utils.REMOTE_TESTS_PATH: identity}:
+                self._set_data_dict(utils.get_data_dict())
+                self._tests_identity = {utils.REMOTE_TESTS_PATH: identity}
+            return
+
+        if utils.REMOTE_TESTS_PATH in self._tests_identity:
+            self._tests_identity = {}
+            self._set_data_dict({})
+
+        data_dict = dict(self.storage.data_dict)
+        tests_identity = {}
+        paths = utils.get_remote_tests_paths()
+        for assignment, filepath in paths.items():
+            identity = _identity(filepath)
+            if identity is None:
+                data_dict.pop(assignment, None)
+                continue
+            if identity != self._tests_identity.get(filepath):
+                try:
+                    data_dict[assignment] = utils.load_remote_tests(filepath)
+                except (EnvironmentError, ValueError):
+                    # the file is being written, it is loaded at the next scan
+                    continue
+            tests_identity[filepath] = identity
+
+        for assignment in set(data_dict) - set(paths):
+            del data_dict[assignment]
+        if tests_identity != self._tests_identity or set(data_dict) != set(self.storage.data_dict):
+            self._set_data_dict(data_dict)
+            self._tests_identity = tests_identity
+
+    def _set_data_dict(self, data_dict):
+        self.storage.data_dict = data_dict
+        self.storage.assignments = tuple(sorted(data_dict))
@@ -0,0 +1,319 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+The state shared by the worker processes of the server.
+It is stored in a SQLite database in WAL mode, so the workers can read
+it concurrently while one of them writes.
+
+SharedRateLimiter
+    A drop-in replacement of `rate_limit.RateLimiter`.
+
+SharedProgressStore
+    A drop-in replacement of `progress_store.ProgressStore`.
+    The per-user json files are still written by the main process. They are
+    merged into the database on each launch, a completion is never lost.
+
+SharedMetrics
+    A drop-in replacement of `metrics.Metrics`. A thread of each worker stores
+    a snapshot of its metrics in the database every `flush_interval` if there
+    were new requests, `/metrics` merges the snapshots of all workers.
+"""
+
+import os
+import json
+import contextlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import metrics
+import progress_store
+import rate_limit
+import utils
+
+
+SCHEMA = """
+DROP TABLE IF EXISTS timeout;
+CREATE TABLE IF NOT EXISTS rate_limit (
+    key TEXT PRIMARY KEY,
+    full_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_limit_full_at ON rate_limit (full_at);
+CREATE TABLE IF NOT EXISTS progress (
+    username TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    completed INTEGER NOT NULL,
+    dirty INTEGER NOT NULL,
+    PRIMARY KEY (username, assignment)
+);
+CREATE INDEX IF NOT EXISTS progress_dirty ON progress (dirty);
+CREATE TABLE IF NOT EXISTS progress_version (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    pid INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL
+);
+"""
+
+
+class Database:
+
+    def __init__(self, path, pool_size=8):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connection(self):
+        # the connections are pooled per process, as the threaded server starts a thread
+        # per request. The nested calls of a thread get its connection, e.g. in a transaction
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            yield connection
+            return
+
+        connection = self._checkout()
+        self._local.connection, self._local.pid = connection, os.getpid()
+        try:
+            yield connection
+        finally:
+            self._local.connection = None
+            self._checkin(connection)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def execute(self, sql, parameters=()):
+        # returns all rows of the result
+        with self.connection() as connection:
+            return connection.execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, parameters):
+        with self.connection() as connection:
+            connection.executemany(sql, parameters)
+
+    def _checkout(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the connections are not shared with the forked processes
+                self._pid, self._idle = os.getpid(), []
+            if self._idle:
+                return self._idle.pop()
+
+        connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _checkin(self, connection):
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+class SharedRateLimiter(rate_limit.RateLimiter):
+
+    def __init__(self, database, limits, sweep_interval=60.0):
+        rate_limit.RateLimiter.__init__(self, limits, sweep_interval)
+        self.database = database
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # the buckets are read and updated atomically across the workers
+        with self.database.transaction():
+            yield
+
+    def _load(self, keys):
+        names = {_bucket_name(key): key for key in keys}
+        rows = self.database.execute(
+            'SELECT key, full_at FROM rate_limit WHERE key IN ({})'.format(
+                ', '.join('?' * len(names))), list(names))
+        return {names[name]: full_at for name, full_at in rows}
+
+    def _store(self, full_at):
+        self.database.executemany(
+            'INSERT OR REPLACE INTO rate_limit (key, full_at) VALUES (?, ?)',
+            [(_bucket_name(key), value) for key, value in full_at.items()])
+
+    def _sweep(self, now):
+        self.database.execute('DELETE FROM rate_limit WHERE full_at <= ?', (now,))
+
+    def __len__(self):
+        return self.database.execute('SELECT COUNT(*) FROM rate_limit')[0][0]
+
+
+def _bucket_name(key):
+    username, endpoint, assignment = key
+    return '/'.join([username, endpoint, assignment or ''])
+
+
+class SharedProgressStore(progress_store.ProgressStore):
+
+    def __init__(self, database, flush_interval=1.0):
+        self.database = database
+        self.flush_interval = flush_interval
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._import_json_files()
+
+    def _import_json_files(self):
+        # the json files are merged on each launch, as they may have been updated
+        # by a single-worker server or by `grade.py`. A completion is never lost
+        self._merge([(username, assignment, completed)
+                     for username, user_progress in utils.get_users_progress().items()
+                     for assignment, completed in user_progress.items()], dirty=0)
+
+    def _merge(self, attempts, dirty):
+        # the progress of the users only moves forward, the versions of the changed users
+        # are incremented
+        with self.database.transaction() as connection:
+            changed = set()
+            for username, assignment, success in attempts:
+                cursor = connection.execute(
+                    'INSERT INTO progress (username, assignment, completed, dirty) '
+                    'VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (username, assignment) DO UPDATE SET completed = 1, '
+                    'dirty = MAX(dirty, excluded.dirty) '
+                    'WHERE completed = 0 AND excluded.completed = 1',
+                    (username, assignment, int(bool(success)), dirty))
+                if cursor.rowcount > 0:
+                    changed.add(username)
+            connection.executemany(
+                'INSERT INTO progress_version VALUES (?, 1) '
+                'ON CONFLICT (username) DO UPDATE SET version = version + 1',
+                [(username,) for username in changed])
+
+    def get(self, username):
+        rows = self.database.execute(
+            'SELECT assignment, completed FROM progress WHERE username = ?', (username,))
+        return {assignment: bool(completed) for assignment, completed in rows}
+
+    def record_attempt(self, username, assignment, success):
+        self.record_attempts([(username, assignment, success)])
+
+    def record_attempts(self, attempts):
+        self._merge(attempts, dirty=1)
+
+    def version(self, username):
+        rows = self.database.execute(
+            'SELECT version FROM progress_version WHERE username = ?', (username,))
+        return rows[0][0] if rows else 0
+
+    def counts(self, assignments):
+        rows = self.database.execute(
+            'SELECT assignment, COUNT(*), SUM(completed) FROM progress GROUP BY assignment')
+        counts = {assignment: (attempted, completed) for assignment, attempted, completed in rows}
+        counts = np.array([counts.get(assignment, (0, 0)) for assignment in assignments],
+                          dtype=np.int64).reshape(-1, 2)
+        return counts[:, 0], counts[:, 1]
+
+    def states(self, usernames, assignments):
+        rows = {username: row for row, username in enumerate(usernames)}
+        columns = {assignment: column for column, assignment in enumerate(assignments)}
+        states = np.zeros((len(rows), len(columns)), dtype=np.int8)
+        for username, assignment, completed in self.database.execute(
+                'SELECT username, assignment, completed FROM progress'):
+            if username in rows and assignment in columns:
+                states[rows[username], columns[assignment]] = \
+                    progress_store.COMPLETED if completed else progress_store.ATTEMPTED
+        return states
+
+    def _take_dirty(self):
+        with self.database.transaction() as connection:
+            rows = connection.execute(
+                'SELECT username, assignment, completed FROM progress WHERE username IN '
+                '(SELECT DISTINCT username FROM progress WHERE dirty = 1)').fetchall()
+            connection.execute('UPDATE progress SET dirty = 0 WHERE dirty = 1')
+
+        dirty = {}
+        for username, assignment, completed in rows:
+            dirty.setdefault(username, {})[assignment] = bool(completed)
+        return dirty
+
+    def _mark_dirty(self, username):
+        self.database.execute(
+            'UPDATE progress SET dirty = 1 WHERE username = ?', (username,))
+
+
+class SharedMetrics(metrics.Metrics):
+
+    def __init__(self, database, flush_interval=1.0):
+        metrics.Metrics.__init__(self)
+        self.database = database
+        self.flush_interval = flush_interval
+        self._thread_pid = None
+        # the number of requests observed and flushed by this process
+        self._observed = 0
+        self._flushed = 0
+
+    def reset(self):
+        # removes the snapshots of the previous launches, called once before the workers start
+        self.database.execute('DELETE FROM metrics')
+
+    def observe(self, route, duration, error=None):
+        metrics.Metrics.observe(self, route, duration, error)
+        self._observed += 1
+        # the threads do not survive a fork, so each worker starts its own one
+        if self._thread_pid != os.getpid():
+            with self._lock:
+                if self._thread_pid != os.getpid():
+                    self._thread_pid = os.getpid()
+                    thread = threading.Thread(target=self._run)
+                    thread.daemon = True
+                    thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._flushed != self._observed:
+                self.flush()
+
+    def flush(self):
+        self._flushed = self._observed
+        self.database.execute(
+            'INSERT OR REPLACE INTO metrics (pid, snapshot) VALUES (?, ?)',
+            (os.getpid(), json.dumps(self.snapshot())))
+
+    def render(self):
+        self.flush()
+        rows = self.database.execute('SELECT snapshot FROM metrics')
+        return metrics.render(metrics.merge(json.loads(snapshot) for snapshot, in rows))
@@ -0,0 +1,82 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+The registry of the users.
+
+The records of all users are loaded once and kept in a dict, so checking
+a username or getting the name and the mail of a user does not touch the
+disk. `update` rescans `users/user_info/` and only reads the files which
+were added or changed since the last scan.
+"""
+
+import utils
+
+
+class User:
+    __slots__ = ('username', 'name', 'mail', 'identity')
+
+    def __init__(self, username, name, mail, identity):
+        self.username = username
+        self.name = name
+        self.mail = mail
+        self.identity = identity
+
+
+class UserRegistry:
+
+    def __init__(self):
+        self._users = {}
+        self.update()
+
+    def __contains__(self, username):
+        return username in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users)
+
+    def get(self, username):
+        return self._users.get(username)
+
+    def update(self):
+        # the new records are swapped in at once, returns True if the registry changed
+        users = {}
+        changed = False
+        for username in utils.get_users_list():
+            identity = utils.get_user_info_identity(username)
+            user = self._users.get(username)
+            if user is None or user.identity != identity:
+                try:
+                    info = utils.get_user_info(username)
+                    user = User(username, info['name'], info['mail'], identity)
+                except (EnvironmentError, ValueError, KeyError, TypeError):
+                    # the file is being written, it is read at the next update
+                    pass
+                else:
+                    changed = True
+            if user is not None:
+                users[username] = user
+
+        if changed or len(users) != len(self._users):
+            self._users = users
+            return True
+        return False
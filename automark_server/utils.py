@@ -18,35 +18,223 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
 import json
+import gzip
 import hashlib
 import pickle
 import glob
-from flask import jsonify, send_from_directory
+import shutil
+import threading
+import numpy as np
+from flask import jsonify, send_file
 
 
 CWD = os.path.dirname(os.path.realpath(__file__))
+LOCAL_TESTS_PATH = os.path.join(CWD, 'assignments/local_tests.pickle')
+LOCAL_TESTS_DIR = os.path.join(CWD, 'assignments/local_tests')
+REMOTE_TESTS_PATH = os.path.join(CWD, 'assignments/remote_tests.pickle')
+REMOTE_TESTS_DIR = os.path.join(CWD, 'assignments/remote_tests')
+SHARED_STATE_PATH = os.path.join(CWD, 'users/shared_state.sqlite3')
+USER_INFO_DIR = os.path.join(CWD, 'users/user_info')
+COMPRESSED_DIR = os.path.join(CWD, 'assignments/compressed')
+COMPRESSIONS = ('gzip',)
+
+# `automark_data` and `automark_compare` are shared with the client
+sys.path.insert(0, os.path.dirname(CWD))
+import automark_compare
+import automark_data
+
+# {filepath: (file identity, md5)} of the last hashed version of the files
+_md5_cache = {}
+# md5 of the last version of `local_tests.pickle` which was split into per-assignment files
+_split_cache = {'md5': None}
+_split_lock = threading.Lock()
+_compress_lock = threading.Lock()
 
 
 ##############
 # tools
 ##############
-def get_md5():
-    fname = os.path.join(CWD, 'assignments/local_tests.pickle')
+def _file_identity(fname):
+    stat = os.stat(fname)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def _file_md5(fname):
+    # the file is rehashed only if it was replaced or modified
+    identity = _file_identity(fname)
+    cached_identity, cached_md5 = _md5_cache.get(fname, (None, None))
+    if identity == cached_identity:
+        return cached_md5
+
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
         for chunk in iter(lambda: f.read(4096), b""):
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    md5 = hash_md5.hexdigest()
+    _md5_cache[fname] = (identity, md5)
+    return md5
+
+
+def get_md5():
+    # md5 of `local_tests.pickle`, None if the local tests are stored per assignment
+    if not os.path.exists(LOCAL_TESTS_PATH):
+        return None
+    return _file_md5(LOCAL_TESTS_PATH)
+
+
+def get_local_tests_manifest():
+    # returns {assignment: md5 of its local tests}
+    if os.path.exists(LOCAL_TESTS_PATH):
+        _split_local_tests()
+
+    manifest = {}
+    for filepath in glob.glob(_local_test_path_by('*')):
+        assignment = os.path.basename(filepath)[:-len(automark_data.EXTENSION)]
+        manifest[assignment] = _file_md5(filepath)
+    return manifest
+
+
+def _split_local_tests():
+    # `local_tests.pickle` is converted into per-assignment files once per version
+    md5 = get_md5()
+    if md5 == _split_cache['md5']:
+        return
+
+    with _split_lock:
+        if md5 == _split_cache['md5']:
+            return
+        with open(LOCAL_TESTS_PATH, 'rb') as f:
+            local_tests = pickle.load(f, encoding='latin1')
+        if not os.path.exists(LOCAL_TESTS_DIR):
+            os.makedirs(LOCAL_TESTS_DIR, exist_ok=True)
+
+        # the other workers may split the same version at the same time
+        for assignment, data in local_tests.items():
+            filepath = _local_test_path_by(assignment)
+            tmp_filepath = '{}.{}.{}.tmp'.format(filepath, os.getpid(), threading.get_ident())
+            automark_data.save(tmp_filepath, data)
+            os.replace(tmp_filepath, filepath)
+        _split_cache['md5'] = md5
+
+
+def _local_test_path_by(assignment):
+    return os.path.join(LOCAL_TESTS_DIR, assignment + automark_data.EXTENSION)
 
 
 def error_response(error):
     return jsonify({"error": error}), 300
 
 
-def send_local_tests():
-    file_dir = os.path.join(CWD, 'assignments')
-    return send_from_directory(file_dir, 'local_tests.pickle')
+def _numeric_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'biufc':
+        raise ValueError('unsupported dtype: {}'.format(dtype))
+    return dtype
+
+
+def is_correct(x_true, x_answer, comparator=None):
+    # the same check as in the local tests of the client
+    return automark_compare.is_correct(x_answer, x_true, comparator)
+
+
+def decode_array(buffer, dtype, shape):
+    # `buffer` holds the raw little-endian data, `shape` is comma-separated
+    dtype = _numeric_dtype(dtype)
+    shape = tuple(int(dim) for dim in shape.split(',') if dim)
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def decode_answers(buffer):
+    # <uint32 header length><json header><raw little-endian buffers>
+    # the answers which are not numeric arrays are in the header as {"json": ..}
+    # returns a list of (assignment, ipd, answer)
+    header_size = int(np.frombuffer(buffer, dtype='<u4', count=1)[0])
+    header = json.loads(buffer[4:4 + header_size].decode('utf-8'))
+    offset = 4 + header_size
+
+    answers = []
+    for item in header:
+        if 'json' in item:
+            answers.append((str(item['assignment']), int(item['ipd']), item['json']))
+            continue
+        dtype = _numeric_dtype(item['dtype'])
+        shape = tuple(int(dim) for dim in item['shape'])
+        count = int(np.prod(shape))
+        answer = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+        answers.append((str(item['assignment']), int(item['ipd']), answer))
+
+    if offset != len(buffer):
+        raise ValueError('unexpected size of the answers.')
+    return answers
+
+
+def send_local_tests(compression=None):
+    return _send_test_file(*local_tests_file(compression))
+
+
+def send_local_test(assignment, compression=None):
+    return _send_test_file(*local_test_file(assignment, compression))
+
+
+def _send_test_file(filepath, etag, mimetype):
+    # `send_file` answers the If-None-Match, Range and If-Range requests
+    return send_file(filepath, mimetype=mimetype, etag=etag)
+
+
+def local_tests_file(compression=None):
+    # returns (path, etag, mimetype) of `local_tests.pickle` or of its compressed copy
+    return _test_file(LOCAL_TESTS_PATH, 'local_tests', get_md5(), compression)
+
+
+def local_test_file(assignment, compression=None):
+    # returns (path, etag, mimetype) of the local tests of the assignment
+    filepath = _local_test_path_by(assignment)
+    return _test_file(filepath, assignment, _file_md5(filepath), compression)
+
+
+def _test_file(filepath, name, md5, compression):
+    if compression == 'gzip':
+        return _compressed_file(filepath, name, md5), md5 + '.gz', 'application/gzip'
+    return filepath, md5, 'application/octet-stream'
+
+
+def _compressed_path_by(name, md5):
+    return os.path.join(COMPRESSED_DIR, '{}.{}.gz'.format(name, md5))
+
+
+def _compressed_file(filepath, name, md5):
+    # the compressed copy is built once per version of the file. It does not
+    # depend on the time, so all workers serve the same bytes and a download
+    # can be resumed from any of them
+    path = _compressed_path_by(name, md5)
+    if os.path.exists(path):
+        return path
+
+    with _compress_lock:
+        if not os.path.exists(path):
+            if not os.path.exists(COMPRESSED_DIR):
+                os.makedirs(COMPRESSED_DIR, exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(filepath, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f_out, mtime=0) as f_gzip:
+                    shutil.copyfileobj(f_in, f_gzip, 1024 * 1024)
+            os.replace(tmp_path, path)
+
+            # the copies of the previous versions are removed
+            for old_path in glob.glob(_compressed_path_by(name, '*')):
+                if old_path != path:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+    return path
+
+
+def _user_info_path_by(username):
+    return os.path.join(USER_INFO_DIR, '{}.json'.format(username))
 
 
 def _user_progress_path_by(username):
@@ -59,14 +247,22 @@ def _user_progress_path_by(username):
 # get
 ##############
 def get_user_info(username):
-    filepath = os.path.join(CWD, 'users/user_info/{}.json'.format(username))
-    with open(filepath) as f:
+    with open(_user_info_path_by(username)) as f:
         data = json.loads(f.read())
     return data
 
 
+def get_user_info_identity(username):
+    # None if the user is not registered
+    try:
+        stat = os.stat(_user_info_path_by(username))
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
 def get_users_list():
-    pattern = os.path.join(CWD, 'users', 'user_info', '*.json')
+    pattern = os.path.join(USER_INFO_DIR, '*.json')
     users = [os.path.basename(f) for f in glob.glob(pattern)]
     users = sorted([f.split('.')[0] for f in users])
     return users
@@ -87,10 +283,67 @@ def get_users_progress():
     return users_progress
 
 
+def _pack_input(input_):
+    # the same structure as `crdict` in `automark_generator.py`
+    packed = {}
+    for key, value in input_.items():
+        if isinstance(value, np.ndarray):
+            packed[key] = {'data': value.tolist(), 'type': 'ndarray'}
+        else:
+            packed[key] = {'data': value, 'type': type(value).__name__}
+    return packed
+
+
+def get_input_json(data, idx):
+    # the inputs are serialized on first use, then `get_test_input` only sends the bytes
+    input_json = data['inputs_json'][idx]
+    if input_json is None:
+        input_ = data['inputs'][idx]
+        if not data['inputs_are_packed']:
+            input_ = _pack_input(input_)
+        input_json = '"ipd": {}, "input": {}'.format(int(data['ipd'][idx]), json.dumps(input_))
+        input_json = input_json.encode('utf-8')
+        data['inputs_json'][idx] = input_json
+    return input_json
+
+
+def _index_remote_tests(data, inputs_are_packed):
+    # map each ipd to the position of its test case
+    data['ipd_index'] = {int(ipd): idx for idx, ipd in enumerate(data['ipd'])}
+    data['inputs_json'] = [None] * len(data['ipd'])
+    data['inputs_are_packed'] = inputs_are_packed
+
+    # outputs of the same shape are stacked into a single contiguous array
+    if not isinstance(data['outputs'], np.ndarray):
+        outputs = [np.asarray(output) for output in data['outputs']]
+        shapes = set(output.shape for output in outputs)
+        if len(shapes) == 1 and all(output.dtype.kind in 'biufc' for output in outputs):
+            data['outputs'] = np.stack(outputs)
+    return data
+
+
+def get_remote_tests_paths():
+    # {assignment: filepath} of the per-assignment files in `remote_tests/`
+    pattern = os.path.join(REMOTE_TESTS_DIR, '*' + automark_data.EXTENSION)
+    return {os.path.basename(filepath)[:-len(automark_data.EXTENSION)]: filepath
+            for filepath in glob.glob(pattern)}
+
+
+def load_remote_tests(filepath):
+    return _index_remote_tests(automark_data.load(filepath), inputs_are_packed=False)
+
+
 def get_data_dict():
-    filepath = os.path.join(CWD, 'assignments/remote_tests.pickle')
-    with open(filepath, 'rb') as f:
+    # `remote_tests.pickle` has the inputs packed with `crdict`,
+    # the per-assignment files in `remote_tests/` are memory-mapped and have raw inputs
+    if not os.path.exists(REMOTE_TESTS_PATH):
+        return {assignment: load_remote_tests(filepath)
+                for assignment, filepath in get_remote_tests_paths().items()}
+
+    with open(REMOTE_TESTS_PATH, 'rb') as f:
         data_dict = pickle.load(f, encoding='latin1')
+    for data in data_dict.values():
+        _index_remote_tests(data, inputs_are_packed=True)
     return data_dict
 
 
@@ -98,7 +351,12 @@ def get_data_dict():
 # update
 ##############
 def update_progress(username, current_progress):
-    # write the current progress to the file
+    # write the current progress to a temporary file and replace the old one
     filepath = _user_progress_path_by(username)
-    with open(filepath, 'w') as f:
+    # the name is unique, so the concurrent writers do not share the temporary file
+    tmp_filepath = '{}.{}.{}.tmp'.format(filepath, os.getpid(), threading.get_ident())
+    with open(tmp_filepath, 'w') as f:
         f.write(json.dumps(current_progress))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
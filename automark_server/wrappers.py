@@ -17,7 +17,11 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from flask import request
+import functools
+import asyncio
 import utils
+import hmac
 import math
 import time
 
@@ -37,6 +41,66 @@ def catch_error(func):
     return wrapper
 
 
+def measure(storage):
+    # ServerErrors are counted as rejected requests, other exceptions as failed ones
+    def _measure(func):
+        def wrapper(**kwargs):
+            route = request.url_rule.rule
+            error = None
+            start = time.perf_counter()
+            try:
+                return func(**kwargs)
+            except ServerError:
+                error = 'rejected'
+                raise
+            except Exception:
+                error = 'exception'
+                raise
+            finally:
+                storage.metrics.observe(route, time.perf_counter() - start, error)
+
+        wrapper.__name__ = "measure_" + func.__name__
+        return wrapper
+
+    return _measure
+
+
+# the `async_` wrappers wrap the coroutines of `asgi.py`,
+# the other wrappers check the request before the coroutine is created
+def async_catch_error(func):
+    async def wrapper(**kwargs):
+        try:
+            return await func(**kwargs)
+        except ServerError as e:
+            return {"error": str(e)}, 300
+
+    wrapper.__name__ = "async_catch_error_" + func.__name__
+    return wrapper
+
+
+def async_measure(storage):
+    def _async_measure(func):
+        async def wrapper(**kwargs):
+            route = kwargs['request'].rule
+            error = None
+            start = time.perf_counter()
+            try:
+                return await func(**kwargs)
+            except ServerError:
+                error = 'rejected'
+                raise
+            except Exception:
+                error = 'exception'
+                raise
+            finally:
+                storage.metrics.observe(route, time.perf_counter() - start, error)
+
+        wrapper.__name__ = "async_measure_" + func.__name__
+        return wrapper
+
+    return _async_measure
+
+
 def check_username(storage):
     def _check_username(func):
         def wrapper(**kwargs):
@@ -51,20 +115,97 @@ def check_username(storage):
     return _check_username
 
 
-def check_timeout(storage):
-    def _check_timeout(func):
+def check_rate_limit(storage, endpoint):
+    # rejects the request if the rate limit of the endpoint is exceeded, does not count it
+    def _check_rate_limit(func):
         def wrapper(**kwargs):
-            username = kwargs['username']
-            if username in storage.timeout:
-                delta = math.ceil(storage.timeout[username] - time.time())
-                if delta > 0.0:
-                    raise ServerError("your timeout expires in {} sec.".format(delta))
+            wait = storage.rate_limit.check(kwargs['username'], endpoint, _assignments(kwargs))
+            if wait > 0.0:
+                raise ServerError("your timeout expires in {} sec.".format(math.ceil(wait)))
+            return func(**kwargs)
+
+        wrapper.__name__ = "check_rate_limit_" + func.__name__
+        return wrapper
+
+    return _check_rate_limit
+
+
+def rate_limit(storage, endpoint):
+    # counts the request towards the rate limit of the endpoint
+    def _rate_limit(func):
+        def wrapper(**kwargs):
+            acquire_rate_limit(storage, kwargs['username'], endpoint, _assignments(kwargs))
             return func(**kwargs)
 
-        wrapper.__name__ = "check_timeout_" + func.__name__
+        wrapper.__name__ = "rate_limit_" + func.__name__
         return wrapper
 
-    return _check_timeout
+    return _rate_limit
+
+
+# the shared rate limiter blocks on the database, so it is called in the executor
+def async_check_rate_limit(storage, endpoint):
+    def _async_check_rate_limit(func):
+        async def wrapper(**kwargs):
+            wait = await _in_executor(storage.rate_limit.check, kwargs['username'], endpoint,
+                                      _assignments(kwargs))
+            if wait > 0.0:
+                raise ServerError("your timeout expires in {} sec.".format(math.ceil(wait)))
+            return await func(**kwargs)
+
+        wrapper.__name__ = "async_check_rate_limit_" + func.__name__
+        return wrapper
+
+    return _async_check_rate_limit
+
+
+def async_rate_limit(storage, endpoint):
+    def _async_rate_limit(func):
+        async def wrapper(**kwargs):
+            await _in_executor(acquire_rate_limit, storage, kwargs['username'], endpoint,
+                               _assignments(kwargs))
+            return await func(**kwargs)
+
+        wrapper.__name__ = "async_rate_limit_" + func.__name__
+        return wrapper
+
+    return _async_rate_limit
+
+
+def _in_executor(func, *args):
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+def acquire_rate_limit(storage, username, endpoint, assignments=(None,)):
+    wait = storage.rate_limit.acquire(username, endpoint, assignments)
+    if wait > 0.0:
+        raise ServerError("your timeout expires in {} sec.".format(math.ceil(wait)))
+
+
+def _assignments(kwargs):
+    if 'assignment' in kwargs:
+        return [kwargs['assignment']]
+    if 'assignments' in kwargs:
+        return kwargs['assignments'].split(',')
+    return [None]
+
+
+def check_instructor(storage):
+    # the instructor routes are only available if `storage.instructor_token` is set
+    def _check_instructor(func):
+        def wrapper(**kwargs):
+            request_ = kwargs['request'] if 'request' in kwargs else request
+            token = request_.headers.get('x-instructor-token') or request_.args.get('token', '')
+            if not storage.instructor_token or \
+                    not hmac.compare_digest(token.encode('utf-8'),
+                                            storage.instructor_token.encode('utf-8')):
+                raise ServerError('the instructor token is not valid.')
+            return func(**kwargs)
+
+        wrapper.__name__ = "check_instructor_" + func.__name__
+        return wrapper
+
+    return _check_instructor
 
 
 def check_assignment(storage):
@@ -81,14 +222,15 @@ def check_assignment(storage):
     return _check_assignment
 
 
-def add_timeout(storage, timeout):
-    def _add_timeout(func):
+def check_assignments(storage):
+    def _check_assignments(func):
         def wrapper(**kwargs):
-            username = kwargs['username']
-            storage.timeout[username] = time.time() + timeout
+            for assignment in kwargs['assignments'].split(','):
+                if not assignment in storage.data_dict:
+                    raise ServerError("assignment '{}' is not found.".format(assignment))
             return func(**kwargs)
 
-        wrapper.__name__ = "add_timeout_" + func.__name__
+        wrapper.__name__ = "check_assignments_" + func.__name__
         return wrapper
 
-    return _add_timeout
+    return _check_assignments
@@ -0,0 +1,361 @@
+"""
+AutoMark is a lightweight tool for testing programming assignments
+ 
+Copyright (C) 2020 Ivan Sosnovik
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+----------------------------------------------------------------------
+
+This script load-tests the server application of AutoMark.
+
+It creates a server in a temporary folder with N synthetic users and
+the assignments of `example/generate_assignments.py`, launches
+`automark_server/main.py` and simulates many students running the client
+protocol concurrently:
+    local_tests_manifest -> load_tests -> get_test_input -> check_answer
+
+It reports the throughput, the p50 / p95 / p99 latency of each endpoint and
+the memory (RSS) of the server processes. The results are saved as json
+and can be compared with the results of another version of AutoMark.
+
+Example:
+    python benchmark.py --users 600 --workers 4 --output results.json
+    python benchmark.py --users 600 --workers 4 --compare results.json
+"""
+
+from __future__ import print_function
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import platform
+import subprocess
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'example'))
+import automark
+import generate_assignments
+
+# the ground truth functions used by the simulated students
+SOLUTIONS = {
+    'matmul': generate_assignments.gt_matmul,
+    'sigmoid': generate_assignments.gt_sigmoid,
+}
+ENDPOINTS = ['local_tests_manifest', 'load_tests', 'get_test_input', 'check_answer']
+
+
+##############
+# server
+##############
+def prepare_server(workdir, n_users, n_cases, max_size):
+    # the same structure as created by `example/prepare_test_env.sh`
+    server_dir = os.path.join(workdir, 'automark_server')
+    for dirname in ['users/user_info', 'users/user_progress', 'assignments']:
+        os.makedirs(os.path.join(server_dir, dirname))
+    for filepath in glob.glob(os.path.join(ROOT, 'automark_server', '*.py')):
+        shutil.copy(filepath, server_dir)
+    shutil.copy(os.path.join(ROOT, 'automark_data.py'), workdir)
+    shutil.copy(os.path.join(ROOT, 'automark_compare.py'), workdir)
+
+    usernames = ['id{}'.format(i) for i in range(1, n_users + 1)]
+    for username in usernames:
+        filepath = os.path.join(server_dir, 'users/user_info', username + '.json')
+        with open(filepath, 'w') as f:
+            json.dump({'name': username, 'mail': 'test@mail.xyz'}, f)
+
+    generate_assignments.generate(os.path.join(server_dir, 'assignments'),
+                                  n_cases=n_cases, max_size=max_size)
+    return server_dir, usernames
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(server_dir, port, workers, script='main.py'):
+    env = dict(os.environ, AUTOMARK_PORT=str(port), AUTOMARK_WORKERS=str(workers))
+    with open(os.devnull, 'w') as devnull:
+        # the server runs in its own process group with its workers
+        process = subprocess.Popen([sys.executable, os.path.join(server_dir, script)],
+                                   env=env, stdout=devnull, stderr=devnull,
+                                   preexec_fn=os.setsid)
+
+    host = 'http://127.0.0.1:{}/'.format(port)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(host + 'local_tests_manifest', timeout=1)
+            return process, host
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError('the server did not start.')
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.wait()
+
+
+def server_rss(pgid):
+    # the total RSS in bytes of the processes of the server, None if /proc is not available
+    total = None
+    for stat_path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            with open(os.path.join(os.path.dirname(stat_path), 'status')) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total = (total or 0) + int(line.split()[1]) * 1024
+        except (EnvironmentError, IndexError, ValueError):
+            continue
+    return total
+
+
+##############
+# students
+##############
+def simulate_student(args):
+    # returns a list of (endpoint, latency in seconds, outcome)
+    host, username, rounds, think_time = args
+    session = requests.Session()
+    records = []
+
+    def call(endpoint, method, path, **kwargs):
+        start = time.time()
+        try:
+            response = session.request(method, host + path, timeout=60, **kwargs)
+            content = response.content
+            latency = time.time() - start
+        except requests.exceptions.RequestException:
+            records.append((endpoint, time.time() - start, 'error'))
+            return None
+        if response.status_code == 200:
+            outcome = 'ok'
+        elif response.status_code == 300:
+            outcome = 'rejected'
+        else:
+            outcome = 'error'
+        records.append((endpoint, latency, outcome))
+        return json.loads(content.decode('utf-8')) if outcome == 'ok' and endpoint != 'load_tests' \
+            else None
+
+    downloaded = set()
+    assignments = sorted(SOLUTIONS)
+    for round_ in range(rounds):
+        assignment = assignments[round_ % len(assignments)]
+        call('local_tests_manifest', 'GET', 'local_tests_manifest')
+        if not assignment in downloaded:
+            call('load_tests', 'GET', 'load_tests/{}/{}'.format(username, assignment))
+            downloaded.add(assignment)
+
+        data = call('get_test_input', 'GET', 'get_test_input/{}/{}'.format(username, assignment))
+        if data is not None:
+            kwargs = {key: np.array(value['data']) if value['type'] == 'ndarray' else value['data']
+                      for key, value in data['input'].items()}
+            answer = np.asarray(SOLUTIONS[assignment](**kwargs))
+            body, headers = automark._encode_array(answer)
+            call('check_answer', 'POST',
+                 'check_answer/{}/{}/{}'.format(username, assignment, data['ipd']),
+                 data=body, headers=headers)
+        if think_time > 0:
+            time.sleep(random.uniform(0, 2 * think_time))
+    return records
+
+
+def simulate_students(args):
+    # runs a chunk of students in threads of a single process
+    host, usernames, rounds, think_time, threads = args
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(simulate_student,
+                           [(host, username, rounds, think_time) for username in usernames])
+    finally:
+        pool.close()
+    return [record for records in results for record in records]
+
+
+##############
+# report
+##############
+def summarize(records, wall_time):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = np.array([r[1] for r in records if r[0] == endpoint])
+        outcomes = [r[2] for r in records if r[0] == endpoint]
+        if len(latencies) == 0:
+            continue
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'ok': outcomes.count('ok'),
+            'rejected': outcomes.count('rejected'),
+            'errors': outcomes.count('error'),
+            'throughput': len(latencies) / wall_time,
+            'mean_ms': float(latencies.mean() * 1000),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+        }
+    return {
+        'requests': len(records),
+        'wall_time': wall_time,
+        'throughput': len(records) / wall_time,
+        'endpoints': endpoints,
+    }
+
+
+def print_summary(results):
+    print('-' * 94)
+    print('| {:22}| {:>9}| {:>9}| {:>9}| {:>7}| {:>9}| {:>9}| {:>9}|'.format(
+        'endpoint', 'requests', 'rejected', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    print('-' * 94)
+    for endpoint, stats in results['endpoints'].items():
+        print('| {:22}| {:>9}| {:>9}| {:>9}| {:>7.1f}| {:>9.2f}| {:>9.2f}| {:>9.2f}|'.format(
+            endpoint, stats['requests'], stats['rejected'], stats['errors'],
+            stats['throughput'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('-' * 94)
+    print('total: {} requests in {:.1f} sec, {:.1f} requests / sec'.format(
+        results['requests'], results['wall_time'], results['throughput']))
+    if results['server_rss']['peak'] is not None:
+        print('server RSS: peak {:.1f} MiB, final {:.1f} MiB'.format(
+            results['server_rss']['peak'] / 2.0 ** 20, results['server_rss']['final'] / 2.0 ** 20))
+
+
+def compare(results, baseline, tolerance):
+    # prints the changes relative to the baseline, returns False if any endpoint regressed
+    ok = True
+    print('compared with the baseline ({}):'.format(baseline.get('version')))
+    for endpoint, stats in results['endpoints'].items():
+        if not endpoint in baseline['endpoints']:
+            continue
+        old = baseline['endpoints'][endpoint]
+        p95_change = stats['p95_ms'] / max(old['p95_ms'], 1e-9) - 1
+        throughput_change = stats['throughput'] / max(old['throughput'], 1e-9) - 1
+        regressed = p95_change > tolerance
+        ok = ok and not regressed
+        print('  {:22} p95 {:+.1%}, throughput {:+.1%}{}'.format(
+            endpoint, p95_change, throughput_change, '  REGRESSION' if regressed else ''))
+    return ok
+
+
+def git_version():
+    try:
+        output = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                         cwd=ROOT, stderr=subprocess.STDOUT)
+        return output.decode('utf-8').strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the AutoMark server')
+    parser.add_argument('--users', type=int, default=600, help='the number of simulated students')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='the number of times each student tests a function')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='the mean pause of a student between the rounds in seconds')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='the number of processes simulating the students')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='the number of concurrent students in each process')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of worker processes of the server')
+    parser.add_argument('--asgi', action='store_true',
+                        help='run the asynchronous server `asgi.py` (requires uvicorn)')
+    parser.add_argument('--n-cases', type=int, default=100,
+                        help='the number of test cases of each assignment')
+    parser.add_argument('--max-size', type=int, default=6,
+                        help='the maximum size of each dimension of the arrays')
+    parser.add_argument('--output', help='save the results to this json file')
+    parser.add_argument('--compare', help='compare the results with this json file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='the allowed relative increase of the p95 latency')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='automark_benchmark_')
+    try:
+        print('Generating {} users and the assignments...'.format(args.users))
+        server_dir, usernames = prepare_server(workdir, args.users, args.n_cases, args.max_size)
+        process, host = start_server(server_dir, free_port(), args.workers,
+                                       'asgi.py' if args.asgi else 'main.py')
+        try:
+            print('Running the benchmark...')
+            sys.stdout.flush()
+            chunks = [(host, usernames[i::args.processes], args.rounds, args.think_time,
+                       args.threads) for i in range(args.processes)]
+            pool = Pool(args.processes)
+            start = time.time()
+            async_result = pool.map_async(simulate_students, chunks)
+
+            peak_rss = server_rss(process.pid)
+            while not async_result.ready():
+                rss = server_rss(process.pid)
+                if rss is not None:
+                    peak_rss = max(peak_rss or 0, rss)
+                async_result.wait(0.5)
+            wall_time = time.time() - start
+            records = [record for chunk in async_result.get() for record in chunk]
+            pool.close()
+            final_rss = server_rss(process.pid)
+        finally:
+            stop_server(process)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = summarize(records, wall_time)
+    results['server_rss'] = {'peak': peak_rss, 'final': final_rss}
+    results['version'] = git_version()
+    results['python'] = platform.python_version()
+    results['parameters'] = vars(args)
+    print_summary(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('The results are saved to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,16 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 This script generates 2 assignments: matmul and sigmoid
 Each assignment is included in a file of local test and in a file of remote tests.
+The tests are generated by `automark_generator.py` in parallel and are reproducible:
+the same `--seed` gives the same inputs and outputs. The "reference_times" of the
+local tests are measured again, so their files and md5 change with each run.
 
+By default, each assignment is written to its own `.amt` file (see `automark_data.py`):
+    ../automark_server/assignments/local_tests/<assignment>.amt
+    ../automark_server/assignments/remote_tests/<assignment>.amt
+The inputs of the remote tests are stored as arrays.
+
+With `--format pickle` the legacy `.pickle` files are written.
 The file of local tests is a `.pickle` file whichhas the following structure
 {
     "assignment1": {
@@ -48,6 +57,10 @@ The file of remote tests is a `.pickle` file which has the following structure
     },
     "assignment2": {...}
 }
+In the legacy file of remote tests the inputs are packed with `crdict`.
+
+The local tests also contain "reference_times": the wall time of the ground truth
+function for each test case. The client compares the time of the student's function with it.
 
 NOTE! the local tests do not contain the "ipd" fields while the remote tests do.
 `ipd` is an identifier used to match the provided and the ground truth outputs 
@@ -55,8 +68,18 @@ for a randomly picked assignment.
 
 """
 
+import os
+import sys
+import argparse
 import numpy as np
 
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '..'))
+from automark_generator import Array, Assignment
+import automark_generator
+
+ASSIGNMENTS_DIR = os.path.join(CWD, '../automark_server/assignments')
+
 
 def gt_matmul(A, B):
     return np.dot(A, B)
@@ -66,105 +89,50 @@ def gt_sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
-def crdict(data):
-    "Utility function to pack arrays"
-    data_type = type(data).__name__
-    if data_type == 'ndarray':
-        return {'data': data.tolist(), 'type': data_type}
-    else:
-        return {'data': data, 'type': data_type}
-
-
 # Assinments
-def create_matmul_remote():
-    data_dict = {'inputs': [], 'outputs': []}
-
-    ipds = list(np.random.choice(10000, 100, replace=False))
-    data_dict['ipd'] = ipds
-
-    for ipd in ipds:
-        n1, n2, n3 = np.random.randint(1, 7, size=3)
-        A = np.random.uniform(-10.0, 10.0, size=(n1, n2))
-        B = np.random.uniform(-10.0, 10.0, size=(n2, n3))
-        result = gt_matmul(A, B)
-
-        data_dict['inputs'].append({
-            'A': crdict(A),
-            'B': crdict(B),
-        })
-        data_dict['outputs'].append(result)
-
-    return data_dict
-
-
-def create_sigmoid_remote():
-    data_dict = {'inputs': [], 'outputs': []}
-
-    ipds = list(np.random.choice(10000, 100, replace=False))
-    data_dict['ipd'] = ipds
-
-    for ipd in ipds:
-        n1 = np.random.randint(1, 7, size=1)
-        x = np.random.uniform(-10.0, 10.0, size=n1)
-        result = gt_sigmoid(x)
-
-        data_dict['inputs'].append({
-            'x': crdict(x),
-        })
-        data_dict['outputs'].append(result)
-
-    return data_dict
-
-
-def create_matmul_local():
-    data_dict = {'inputs': [], 'outputs': []}
-
-    for _ in range(100):
-        n1, n2, n3 = np.random.randint(1, 7, size=3)
-        A = np.random.uniform(-10.0, 10.0, size=(n1, n2))
-        B = np.random.uniform(-10.0, 10.0, size=(n2, n3))
-        result = gt_matmul(A, B)
-
-        data_dict['inputs'].append({
-            'A': A,
-            'B': B,
-        })
-        data_dict['outputs'].append(result)
-
-    return data_dict
-
-
-def create_sigmoid_local():
-    data_dict = {'inputs': [], 'outputs': []}
-
-    for _ in range(100):
-        n1 = np.random.randint(1, 7, size=1)
-        x = np.random.uniform(-10.0, 10.0, size=n1)
-        result = gt_sigmoid(x)
-
-        data_dict['inputs'].append({
-            'x': x,
-        })
-        data_dict['outputs'].append(result)
-
-    return data_dict
+def create_assignments(n_cases=100, max_size=6):
+    size = (1, max_size)
+    return [
+        Assignment('sigmoid', gt_sigmoid,
+                   inputs={'x': Array(('n1',), -10.0, 10.0)},
+                   dims={'n1': size},
+                   n_local=n_cases, n_remote=n_cases),
+        Assignment('matmul', gt_matmul,
+                   inputs={'A': Array(('n1', 'n2'), -10.0, 10.0),
+                           'B': Array(('n2', 'n3'), -10.0, 10.0)},
+                   dims={'n1': size, 'n2': size, 'n3': size},
+                   n_local=n_cases, n_remote=n_cases),
+    ]
+
+
+def generate(assignments_dir=ASSIGNMENTS_DIR, fmt='amt', n_cases=100, max_size=6, seed=0,
+             processes=None):
+    """Generate the local and the remote tests of all assignments
+    # Args:
+        assignments_dir - the `assignments` folder of the server
+        fmt - 'amt' or 'pickle'
+        n_cases - the number of test cases of each assignment
+        max_size - the maximum size of each dimension of the arrays
+        seed - the seed of the random generators
+        processes - the number of processes, all CPUs by default
+    """
+    automark_generator.generate(create_assignments(n_cases, max_size), assignments_dir,
+                                seed=seed, processes=processes, fmt=fmt)
 
 
 if __name__ == '__main__':
-    import pickle
-
-    local_tests = {
-        'sigmoid': create_sigmoid_local(),
-        'matmul': create_matmul_local()
-    }
-
-    with open('../automark_server/assignments/local_tests.pickle', 'wb') as f:
-        pickle.dump(local_tests, f, protocol=2)
-
-    remote_tests = {
-        'sigmoid': create_sigmoid_remote(),
-        'matmul': create_matmul_remote()
-    }
-
-    with open('../automark_server/assignments/remote_tests.pickle', 'wb') as f:
-        pickle.dump(remote_tests, f, protocol=2)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', choices=['amt', 'pickle'], default='amt')
+    parser.add_argument('--output', default=ASSIGNMENTS_DIR,
+                        help='the assignments folder of the server')
+    parser.add_argument('--n-cases', type=int, default=100,
+                        help='the number of test cases of each assignment')
+    parser.add_argument('--max-size', type=int, default=6,
+                        help='the maximum size of each dimension of the arrays')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the seed of the random generators')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='the number of processes, all CPUs by default')
+    args = parser.parse_args()
+
+    generate(args.output, args.format, args.n_cases, args.max_size, args.seed, args.processes)